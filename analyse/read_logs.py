@@ -1,9 +1,32 @@
 __author__ = 'jph'
+
+"""
+read_logs.py reads the event logs for analysis
+
+Text logs (log.txt) are parsed once into a columnar cache next to the log (<log>.cols): one .npy array per
+event type and field, typed like the binary journal (ints with -1, floats with NaN for missing values,
+timestamps as datetime64 wall-clock time, strings as bytes). Large logs are split into byte ranges that are
+parsed on a process pool, later calls only parse what was appended and load the event types, columns and
+time range they need from memory-mapped arrays.
+"""
+
+import os
 import json
+import hashlib
 import pdb
+import multiprocessing
 
+import numpy as np
 import pandas as pd
 
+from lib.journal import read_journal, COMMON, FIELDS, NULL_INT
+
+LOG_TYPES = ('MARKET', 'SIGNAL', 'ORDER', 'FILL')
+CACHE_TYPES = ('MARKET', 'SIGNAL', 'ORDER', 'FILL', 'SCHEDULE', 'ERROR', 'STOP')
+LOG_FIELDS = dict((type, dict(COMMON + fields)) for type, fields in FIELDS.iteritems())
+DATE_COLUMNS = ('timestamp', 'lasttimestamp')
+CHUNKSIZE = 32 * 2 ** 20
+
 
 def json_to_workfile(json_list):
     workfile = pd.DataFrame(json_list)
@@ -12,31 +35,260 @@ def json_to_workfile(json_list):
     return workfile
 
 
-def read_logfile(log='log.txt'):
-    with open(log, 'r') as logfile:
-        market = []
-        signal = []
-        order = []
-        fill = []
-        for line in logfile:
-            elements = line.split(',', 2)
-            if elements[1] == "MARKET":
-                market.append(json.loads(elements[2]))
-            elif elements[1] == "SIGNAL":
-                signal.append(json.loads(elements[2]))
-            elif elements[1] == "ORDER":
-                order.append(json.loads(elements[2]))
-            elif elements[1] == "FILL":
-                fill.append(json.loads(elements[2]))
-    print "Market: %s" % len(market)
-    print "Signal: %s" % len(signal)
-    print "Order: %s" % len(order)
-    print "Fill: %s" % len(fill)
-    market = json_to_workfile(market)
-    signal = json_to_workfile(signal)
-    order = json_to_workfile(order)
-    fill = json_to_workfile(fill)
-    return market, signal, order, fill
+def read_logfile(log='log.txt', processes=None):
+    """
+    Reads the market, signal, order and fill events of a text log (see load_log)
+    """
+    frames = load_log(log, types=LOG_TYPES, processes=processes)
+    for type in LOG_TYPES:
+        print "%s: %s" % (type.capitalize(), len(frames[type]))
+    return tuple(frames[type] for type in LOG_TYPES)
+
+
+def complete_size(log):
+    """
+    bytes of the log up to its last line break, a line the live system is still writing is left out
+    """
+    end = os.path.getsize(log)
+    with open(log, 'rb') as logfile:
+        while end > 0:
+            begin = max(end - 4096, 0)
+            logfile.seek(begin)
+            newline = logfile.read(end - begin).rfind('\n')
+            if newline >= 0:
+                return begin + newline + 1
+            end = begin
+    return 0
+
+
+def fingerprint(log):
+    """
+    identity of the log file - inode and md5 of its first line, a rotated or rewritten log gets a new one
+    """
+    with open(log, 'rb') as logfile:
+        first = logfile.readline()
+    return '%d:%s' % (os.stat(log).st_ino, hashlib.md5(first).hexdigest())
+
+
+def byte_ranges(log, chunksize=CHUNKSIZE, start=0, size=None):
+    """
+    (start, end) byte ranges of about chunksize bytes from start to size (default complete_size),
+    every range ends after a full line
+    """
+    size = complete_size(log) if size is None else size
+    ranges = []
+    with open(log, 'rb') as logfile:
+        while start < size:
+            logfile.seek(min(start + chunksize, size))
+            logfile.readline()
+            end = min(logfile.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _wall_time(value):
+    """
+    timestamp string without its utc offset
+    """
+    if value is not None and len(value) > 19 and value[-6] in '+-' and value[-3] == ':':
+        return value[:-6]
+    return value
+
+
+def _text(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return '' if value is None else str(value)
+
+
+def _column(type, name, values):
+    """
+    log values as datetime64, int (missing -1), float (missing NaN) or byte string array
+    """
+    code = LOG_FIELDS.get(type, {}).get(name)
+    if name in DATE_COLUMNS:
+        return pd.to_datetime([_wall_time(value) for value in values], errors='coerce').values
+    elif code == 'q':
+        return np.array([NULL_INT if value is None else value for value in values], dtype=np.int64)
+    elif code == 'd':
+        return np.array(values, dtype=float)
+    return np.array([value.encode('utf-8') if isinstance(value, unicode) else _text(value) for value in values],
+                    dtype=str)
+
+
+def _parse_range(job):
+    """
+    columns per event type of the log lines in one byte range
+    """
+    log, start, end, types = job
+    records = dict((type, []) for type in types)
+    with open(log, 'rb') as logfile:
+        logfile.seek(start)
+        data = logfile.read(end - start)
+    decode = json.JSONDecoder().decode
+    for line in data.splitlines():
+        elements = line.split(',', 2)
+        if len(elements) == 3 and elements[1] in records:
+            records[elements[1]].append(decode(elements[2]))
+    columns = {}
+    for type, rows in records.iteritems():
+        names = sorted(str(name) for name in set().union(*rows))
+        columns[type] = dict((name, _column(type, name, [row.get(name) for row in rows])) for name in names)
+        columns[type]['_rows'] = len(rows)
+    return columns
+
+
+def _empty(column, rows):
+    """
+    missing values in the dtype of column: -1, NaN, NaT or ''
+    """
+    if column.dtype.kind == 'i':
+        return np.full(rows, NULL_INT, dtype=column.dtype)
+    elif column.dtype.kind == 'f':
+        return np.full(rows, np.nan)
+    elif column.dtype.kind == 'M':
+        return np.full(rows, np.datetime64('NaT'), dtype=column.dtype)
+    return np.zeros(rows, dtype=column.dtype)
+
+
+def _concat(parts):
+    """
+    joins the columns of several ranges of one event type, columns missing in a range are filled
+    """
+    names = sorted(set(name for part in parts for name in part if name != '_rows'))
+    columns = {}
+    for name in names:
+        template = next(part[name] for part in parts if name in part)
+        columns[name] = np.concatenate([part[name] if name in part else _empty(template, part['_rows'])
+                                        for part in parts])
+    columns['_rows'] = sum(part['_rows'] for part in parts)
+    return columns
+
+
+def parse_log(log, types=LOG_TYPES, start=0, processes=None, chunksize=CHUNKSIZE, size=None):
+    """
+    columns per event type of the complete log lines from byte start to size (default complete_size),
+    byte ranges are parsed on a process pool
+    """
+    jobs = [(log, begin, end, types) for begin, end in byte_ranges(log, chunksize, start, size)]
+    if len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_parse_range, jobs)
+        finally:
+            pool.terminate()
+    else:
+        parts = [_parse_range(job) for job in jobs]
+    empty = dict((type, {'_rows': 0}) for type in types)
+    return dict((type, _concat([empty[type]] + [part[type] for part in parts])) for type in types)
+
+
+def cache_log(log='log.txt', processes=None, chunksize=CHUNKSIZE):
+    """
+    Builds or updates the columnar cache of a log: <log>.cols/<TYPE>.<column>.npy and meta.json
+    the log is append-only, so only the lines completed since the last call are parsed, size in meta.json is
+    the end of the last complete line
+    the cache is rebuilt if the log is not the cached file any more (fingerprint, e.g. after a LogWriter rotation)
+    returns the cache directory
+    """
+    path = log + '.cols'
+    size = complete_size(log)
+    identity = fingerprint(log)
+    meta = {'size': 0, 'types': {}, 'fingerprint': identity}
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        with open(os.path.join(path, 'meta.json')) as metafile:
+            cached = json.load(metafile)
+        if cached.get('fingerprint') == identity and cached['size'] <= size:
+            meta = cached
+            if meta['size'] == size:
+                return path
+    elif not os.path.isdir(path):
+        os.makedirs(path)
+    new = parse_log(log, types=CACHE_TYPES, start=meta['size'], processes=processes, chunksize=chunksize,
+                    size=size)
+    for type in CACHE_TYPES:
+        if not new[type]['_rows']:
+            continue
+        parts = [new[type]]
+        if type in meta['types']:
+            old = dict((name, np.load(os.path.join(path, '%s.%s.npy' % (type, name))))
+                       for name in meta['types'][type]['columns'])
+            old['_rows'] = meta['types'][type]['rows']
+            parts.insert(0, old)
+        columns = _concat(parts)
+        names = sorted(name for name in columns if name != '_rows')
+        for name in names:
+            np.save(os.path.join(path, '%s.%s.npy' % (type, name)), columns[name])
+        stamps = columns['timestamp'].view(np.int64)
+        meta['types'][type] = {'columns': names, 'rows': columns['_rows'],
+                               'sorted': bool(np.all(stamps[1:] >= stamps[:-1]))}
+    meta['size'] = size
+    with open(os.path.join(path, 'meta.json'), 'w') as metafile:
+        json.dump(meta, metafile)
+    return path
+
+
+def empty_frame(type, columns=None):
+    """
+    DataFrame without rows with the typed columns events of type have in the log
+    """
+    names = ['event'] + [name for name, code in COMMON + FIELDS.get(type, []) if name not in ('code', 'timestamp')]
+    names = sorted(name for name in names if columns is None or name in columns)
+    return pd.DataFrame(dict((name, _column(type, name, [])) for name in names),
+                        index=pd.DatetimeIndex([], name='timestamp'), columns=names)
+
+
+def load_log(log='log.txt', types=LOG_TYPES, start=None, end=None, columns=None, processes=None):
+    """
+    DataFrames per event type from the columnar cache of a log, indexed by event timestamp
+    the cache is built or updated first, only the requested types and columns are read (memory-mapped)
+    types without events in the log get an empty_frame
+    start, end - event timestamp range, end exclusive
+    """
+    path = cache_log(log, processes=processes)
+    with open(os.path.join(path, 'meta.json')) as metafile:
+        meta = json.load(metafile)
+    frames = {}
+    for type in types:
+        info = meta['types'].get(type)
+        if info is None:
+            frames[type] = empty_frame(type, columns)
+            continue
+        load = lambda name: np.load(os.path.join(path, '%s.%s.npy' % (type, name)), mmap_mode='r')
+        stamps = load('timestamp')
+        if info['sorted']:
+            first = 0 if start is None else stamps.searchsorted(np.datetime64(pd.Timestamp(start)))
+            last = len(stamps) if end is None else stamps.searchsorted(np.datetime64(pd.Timestamp(end)))
+            rows = slice(first, last)
+        else:
+            rows = np.ones(len(stamps), dtype=bool)
+            if start is not None:
+                rows &= stamps >= np.datetime64(pd.Timestamp(start))
+            if end is not None:
+                rows &= stamps < np.datetime64(pd.Timestamp(end))
+        names = [str(name) for name in info['columns']
+                 if name != 'timestamp' and (columns is None or name in columns)]
+        frames[type] = pd.DataFrame(dict((name, np.asarray(load(name)[rows])) for name in names),
+                                    index=pd.DatetimeIndex(np.asarray(stamps[rows]), name='timestamp'),
+                                    columns=names)
+    return frames
+
+
+def read_journalfile(journal='log.jrn', start=None, end=None):
+    """
+    Reads a binary event journal into the same market, signal, order, fill DataFrames as read_logfile
+    """
+    decoded = read_journal(journal, types=('MARKET', 'SIGNAL', 'ORDER', 'FILL'), start=start, end=end)
+    frames = []
+    for type in ('MARKET', 'SIGNAL', 'ORDER', 'FILL'):
+        frame = pd.DataFrame(decoded[type]).drop('code', 1)
+        frame = frame.set_index(pd.to_datetime(frame.timestamp, unit='us'))
+        if type == 'MARKET':
+            frame['lasttimestamp'] = pd.to_datetime(frame.lasttimestamp, unit='us')
+        frames.append(frame.drop('timestamp', 1))
+        print "%s: %s" % (type.capitalize(), len(frame))
+    return tuple(frames)
 
 
 def calc_costs(fill, signal):
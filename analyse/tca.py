@@ -0,0 +1,170 @@
+__author__ = 'jph'
+
+"""
+tca.py provides a vectorized transaction cost analysis of the event logs
+
+Input are the market, signal, order and fill DataFrames of read_logs (read_logfile, load_log, read_journalfile),
+indexed by event timestamp. Every fill is joined in one pass with
+its order (ordereventid) and signal (signalid) - exact id joins through searchsorted on the sorted ids
+the prevailing MARKET event at order time (arrival price) and at signal time (bar to signal latency)
+- as-of joins through searchsorted on the event timestamps
+the open of the bar after the arrival bar, if the bar data is given
+
+Slippage is in basis points of the reference price, positive is a cost for BUY and SELL alike.
+slippage_trigger is measured against the signal trigger, for LMT orders against the order limit.
+Latencies are in seconds.
+"""
+
+import numpy as np
+import pandas as pd
+
+from analyse.read_logs import read_logfile
+
+GROUPS = ('side', 'hour', 'order_type')
+MEASURES = ['slippage_trigger', 'slippage_arrival', 'slippage_next_open', 'commission_bps', 'latency_bar_signal',
+            'latency_signal_order', 'latency_order_fill']
+COLUMNS = ['side', 'order_type', 'hour', 'quantity', 'price', 'trigger', 'limit', 'arrival', 'next_open',
+           'commission'] + MEASURES
+
+
+def asof(stamps, targets):
+    """
+    position of the last of the sorted stamps at or before every target, -1 if there is none
+    """
+    return np.searchsorted(stamps, targets, side='right') - 1
+
+
+def lookup(ids, keys):
+    """
+    position of every key in ids (unsorted, unique), -1 if it is missing
+    """
+    if len(ids) == 0:
+        return np.full(len(keys), -1, dtype=np.int64)
+    order = np.argsort(ids, kind='mergesort')
+    ordered = ids[order]
+    positions = np.clip(np.searchsorted(ordered, keys), 0, len(ordered) - 1)
+    return np.where(ordered[positions] == keys, order[positions], -1)
+
+
+def take(values, positions):
+    """
+    values at positions as float, NaN where the position is -1
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return np.full(len(positions), np.nan)
+    result = values[np.maximum(positions, 0)]
+    result[positions < 0] = np.nan
+    return result
+
+
+def _seconds(stamps):
+    """
+    DatetimeIndex or datetime64 array as float seconds, NaT as NaN
+    """
+    stamps = np.asarray(stamps, dtype='datetime64[ns]')
+    seconds = stamps.view(np.int64) / 1e9
+    seconds[np.isnat(stamps)] = np.nan
+    return seconds
+
+
+def _values(frame, name):
+    """
+    column name of frame as array, empty if the frame has no such column (e.g. pd.DataFrame() for no events)
+    """
+    return frame[name].values if name in frame else np.array([])
+
+
+def _sorted(frame):
+    return frame if frame.index.is_monotonic_increasing else frame.sort_index(kind='mergesort')
+
+
+def transaction_costs(market, signal, order, fill, bars=None):
+    """
+    DataFrame with one row per fill: prices, references, slippages, commission and latencies
+    bars - bar DataFrame with an open column, indexed like MarketDataEvent.lasttimestamp, for next_open
+    without fills the frame is empty (with all columns)
+    """
+    if len(fill) == 0:
+        empty = dict((column, np.array([], dtype=object if column in ('side', 'order_type') else float))
+                     for column in COLUMNS)
+        return pd.DataFrame(empty, index=pd.DatetimeIndex([], name=fill.index.name), columns=COLUMNS)
+    market = _sorted(market)
+    market_seconds = _seconds(market.index)
+    fill_seconds = _seconds(fill.index)
+
+    in_order = lookup(_values(order, 'id'), fill['ordereventid'].values)
+    in_signal = lookup(_values(signal, 'id'), fill['signalid'].values)
+    order_seconds = take(_seconds(order.index), in_order)
+    signal_seconds = take(_seconds(signal.index), in_signal)
+
+    arrival_bar = asof(market_seconds, order_seconds)
+    arrival_bar[np.isnan(order_seconds)] = -1
+    signal_bar = asof(market_seconds, signal_seconds)
+    signal_bar[np.isnan(signal_seconds)] = -1
+
+    side = np.where(fill['side'].values == 'BUY', 1.0, -1.0)
+    price = fill['price'].values.astype(float)
+    quantity = fill['quantity'].values.astype(float)
+    trigger = take(_values(signal, 'trigger'), in_signal)
+    limit = take(_values(order, 'limit'), in_order)
+    order_type = np.full(len(fill), '', dtype=object)
+    order_type[in_order >= 0] = _values(order, 'order_type')[in_order[in_order >= 0]]
+    reference = np.where(order_type == 'LMT', limit, trigger)
+    arrival = take(_values(market, 'close'), arrival_bar)
+    next_open = np.full(len(fill), np.nan)
+    if bars is not None:
+        bar_seconds = _seconds(bars.index)
+        arrival_stamp = take(_seconds(_values(market, 'lasttimestamp')), arrival_bar)
+        next_bar = asof(bar_seconds, arrival_stamp) + 1
+        next_bar[np.isnan(arrival_stamp) | (next_bar >= len(bars))] = -1
+        next_open = take(bars['open'].values, next_bar)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        costs = pd.DataFrame({
+            'side': fill['side'].values,
+            'order_type': order_type,
+            'hour': fill.index.hour,
+            'quantity': quantity,
+            'price': price,
+            'trigger': trigger,
+            'limit': limit,
+            'arrival': arrival,
+            'next_open': next_open,
+            'slippage_trigger': side * (price - reference) / reference * 1e4,
+            'slippage_arrival': side * (price - arrival) / arrival * 1e4,
+            'slippage_next_open': side * (price - next_open) / next_open * 1e4,
+            'commission': fill['total_cost'].values.astype(float),
+            'commission_bps': fill['total_cost'].values / (quantity * price) * 1e4,
+            'latency_bar_signal': signal_seconds - take(market_seconds, signal_bar),
+            'latency_signal_order': order_seconds - signal_seconds,
+            'latency_order_fill': fill_seconds - order_seconds},
+            index=fill.index, columns=COLUMNS)
+    return costs
+
+
+def summarize(costs, by=GROUPS):
+    """
+    dict group column: count, notional weighted mean and median of every measure per group
+    """
+    notional = costs.quantity * costs.price
+    summary = {}
+    for column in by:
+        grouped = costs.groupby(column)
+        weighted = {}
+        for measure in MEASURES:
+            weights = notional.where(costs[measure].notnull())
+            weighted[measure] = ((costs[measure] * weights).groupby(costs[column]).sum() /
+                                 weights.groupby(costs[column]).sum())
+        table = pd.DataFrame({'fills': grouped.size(), 'quantity': grouped.quantity.sum()})
+        summary[column] = table.join(pd.DataFrame(weighted)[MEASURES]).join(
+            grouped[MEASURES].median().add_suffix('_median'))
+    return summary
+
+
+if __name__ == "__main__":
+    import sys
+
+    market, signal, order, fill = read_logfile(sys.argv[1] if len(sys.argv) > 1 else 'log.txt')
+    for column, table in sorted(summarize(transaction_costs(market, signal, order, fill)).iteritems()):
+        print table.to_string()
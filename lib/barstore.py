@@ -0,0 +1,139 @@
+__author__ = 'jph'
+
+"""
+barstore.py provides an on-disk columnar bar format
+
+A store is a directory with one memory-mapped array per field (open/high/low/close/volume),
+an int64 timestamp index and a date-range index, so histories open instantly and only the
+rows that are actually touched are paged in.
+
+meta.json - fields, dtypes, length and timezone of the index
+index.bin - int64 timestamps (ns), sorted ascending
+<field>.bin - one array per field
+days.bin - date-range index, (day start ns, first row of that day) pairs
+"""
+
+import os
+import sys
+import json
+import pickle
+
+import numpy as np
+import pandas as pd
+
+NS_PER_DAY = 24 * 60 * 60 * 10 ** 9
+
+
+class BarStore(object):
+    """
+    Read-only access to a columnar bar store
+    stamps and columns are memory-mapped, slicing them does not load the whole history
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as metafile:
+            meta = json.load(metafile)
+        self.fields = [str(field) for field in meta['fields']]
+        self.length = meta['length']
+        self.tz = meta['tz']
+        self.stamps = self._map('index', np.int64, self.length)
+        self.columns = dict((field, self._map(field, meta['dtypes'][field], self.length)) for field in self.fields)
+        self.days = self._map('days', np.int64, 2 * meta['days']).reshape(-1, 2)
+
+    def __len__(self):
+        return self.length
+
+    def _map(self, name, dtype, length):
+        if length == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype, mode='r', shape=(length,))
+
+    def position(self, timestamp, side='left'):
+        """
+        row number of timestamp - looks up the day in the date-range index and bisects only inside that day
+        """
+        timestamp = pd.Timestamp(timestamp)
+        if self.tz is not None and timestamp.tzinfo is None:
+            timestamp = timestamp.tz_localize(self.tz)
+        ns = timestamp.value
+        day = ns - ns % NS_PER_DAY
+        i = np.searchsorted(self.days[:, 0], day, side='right')
+        if i == 0:
+            return 0
+        first = self.days[i - 1, 1]
+        last = self.days[i, 1] if i < len(self.days) else self.length
+        return int(first + np.searchsorted(self.stamps[first:last], ns, side=side))
+
+    def locate(self, start=None, end=None):
+        """
+        returns (first row, last row + 1) for the date range start..end, both inclusive
+        """
+        lo = 0 if start is None else self.position(start)
+        hi = self.length if end is None else self.position(end, side='right')
+        return lo, max(lo, hi)
+
+    def frame(self, start=None, end=None):
+        """
+        loads the date range start..end into a DataFrame
+        """
+        lo, hi = self.locate(start, end)
+        data = pd.DataFrame(dict((field, np.array(self.columns[field][lo:hi])) for field in self.fields),
+                            index=pd.DatetimeIndex(np.array(self.stamps[lo:hi])), columns=self.fields)
+        if self.tz is not None:
+            data = data.tz_localize('UTC').tz_convert(self.tz)
+        return data
+
+    def chunks(self, chunksize=100000, start=None, end=None):
+        """
+        Generator over the date range start..end in chunks of chunksize bars
+        yields (stamps, dict of columns) as in-memory copies, so only the current chunk stays resident
+        """
+        lo, hi = self.locate(start, end)
+        for first in xrange(lo, hi, chunksize):
+            last = min(first + chunksize, hi)
+            yield (np.array(self.stamps[first:last]),
+                   dict((field, np.array(self.columns[field][first:last])) for field in self.fields))
+
+
+def write_barstore(data, path):
+    """
+    Writes a bar DataFrame with a DatetimeIndex to a new store directory
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    data = data.sort_index()
+    stamps = data.index.asi8
+    days = stamps - stamps % NS_PER_DAY
+    firstrows = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1]))) if len(days) else np.empty(0, int)
+    dayindex = np.column_stack((days[firstrows], firstrows)).astype(np.int64)
+
+    stamps.astype(np.int64).tofile(os.path.join(path, 'index.bin'))
+    dayindex.tofile(os.path.join(path, 'days.bin'))
+    dtypes = {}
+    for field in data.columns:
+        values = data[field].values
+        if values.dtype.kind not in 'iuf':
+            values = values.astype(np.float64)
+        dtypes[str(field)] = values.dtype.str
+        values.tofile(os.path.join(path, str(field) + '.bin'))
+
+    tz = None if data.index.tz is None else str(data.index.tz)
+    with open(os.path.join(path, 'meta.json'), 'w') as metafile:
+        json.dump({'fields': [str(field) for field in data.columns], 'dtypes': dtypes, 'length': len(data),
+                   'days': len(dayindex), 'tz': tz}, metafile)
+    return BarStore(path)
+
+
+def pickle_to_barstore(workfile, path=None):
+    """
+    Converts a pickled workfile (e.g. workfile_tmp.p, minutedata_*.p) to a store next to it
+    """
+    if path is None:
+        path = os.path.splitext(workfile)[0] + '.bars'
+    return write_barstore(pickle.load(open(workfile, 'rb')), path)
+
+
+if __name__ == "__main__":
+    store = pickle_to_barstore(*sys.argv[1:3])
+    print store.path, store.length
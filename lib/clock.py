@@ -0,0 +1,113 @@
+__author__ = 'jph'
+
+"""
+clock.py provides the time source shared by events, scheduler, data handler and trading handler
+
+LiveClock - wall-clock time of the machine
+SimulatedClock - time set by the data handler to the latest bar, sleep only moves the simulated time
+
+now() returns a naive datetime in the timezone tz of the clock, time() seconds since the epoch.
+"""
+
+import time
+import calendar
+import datetime as dt
+
+import pytz
+import pandas as pd
+
+
+class Clock(object):
+    """
+    Provides interfaces for all clocks
+    """
+
+    def __init__(self, tz):
+        self.tz = pytz.timezone(tz)
+
+    def now(self):
+        raise NotImplementedError
+
+    def time(self):
+        raise NotImplementedError
+
+    def sleep(self, seconds):
+        raise NotImplementedError
+
+    def set(self, timestamp):
+        """
+        moves a simulated clock to timestamp, live clocks ignore it
+        """
+        pass
+
+    def localize(self, timestamp):
+        """
+        naive timestamp of this clock as timezone aware datetime
+        """
+        return self.tz.localize(timestamp)
+
+
+class LiveClock(Clock):
+    """
+    Wall-clock time, the machine runs in tz
+    """
+
+    def __init__(self, tz='Europe/Berlin'):
+        super(LiveClock, self).__init__(tz)
+
+    def now(self):
+        return dt.datetime.today()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class SimulatedClock(Clock):
+    """
+    Simulated time, advanced with the bar timestamps by the data handler
+    bar timestamps are naive times of the exchange timezone tz
+    """
+
+    def __init__(self, start=None, tz='US/Eastern'):
+        super(SimulatedClock, self).__init__(tz)
+        self.current = start
+        self.seconds = None
+        self.hour = None
+        self.offset = None
+
+    def set(self, timestamp):
+        """
+        moves the clock to timestamp, the clock never goes backwards
+        """
+        if self.current is None or timestamp > self.current:
+            self.current = timestamp
+            self.seconds = None
+
+    def now(self):
+        return self.current
+
+    def time(self):
+        """
+        seconds since the epoch, the utc offset is only looked up once per hour of bars
+        """
+        if self.seconds is None:
+            if isinstance(self.current, pd.Timestamp):
+                seconds = self.current.value / 1e9
+            else:
+                seconds = calendar.timegm(self.current.timetuple()) + self.current.microsecond / 1e6
+            hour = seconds // 3600
+            if hour != self.hour:
+                self.hour = hour
+                self.offset = self.localize(self.current).utcoffset().total_seconds()
+            self.seconds = seconds - self.offset
+        return self.seconds
+
+    def sleep(self, seconds):
+        """
+        moves the clock forward, a clock without time (no start, no bar yet) stays unset
+        """
+        if self.current is not None:
+            self.set(self.current + dt.timedelta(seconds=seconds))
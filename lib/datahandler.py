@@ -1,20 +1,101 @@
 __author__ = 'jph'
 
+import os
+import heapq
 import pickle
 from math import floor
 
 import pytz
+import numpy as np
 import pandas as pd
 
 from events import MarketDataEvent, StartStopEvent, ErrorEvent
+from barstore import BarStore
+from util import prefetch
+
+
+def frame_columns(data):
+    """
+    bar DataFrame as (int64 timestamps, dict of column arrays)
+    """
+    return data.index.asi8, dict((field, data[field].values) for field in data.columns)
+
+
+def read_columns(workfile):
+    """
+    Reads a workfile (pickle or BarStore directory) as (fields, int64 timestamps, dict of column arrays)
+    BarStore columns stay memory-mapped
+    """
+    if os.path.isdir(workfile):
+        store = BarStore(workfile)
+        return store.fields, store.stamps, store.columns
+    data = pickle.load(open(workfile, 'rb'))
+    stamps, columns = frame_columns(data)
+    return list(data.columns), stamps, columns
+
+
+def read_chunks(workfile, chunksize=100000):
+    """
+    Generator over a workfile in chunks of chunksize bars as (int64 timestamps, dict of column arrays)
+    BarStore directories and csv files (timestamp in the first column) are read from disk chunk by chunk
+    """
+    if os.path.isdir(workfile):
+        for chunk in BarStore(workfile).chunks(chunksize):
+            yield chunk
+    else:
+        for data in pd.read_csv(workfile, index_col=0, parse_dates=True, chunksize=chunksize):
+            yield frame_columns(data)
+
+
+class BarWindow(object):
+    """
+    Bounded lookback window of the latest size bars
+    arrays hold 2 * size bars and are compacted when full, so appending is amortized O(1)
+    and the latest bars are always a contiguous slice
+    """
+
+    def __init__(self, size, fields, dtypes):
+        self.size = size
+        self.fields = fields
+        self.stamps = np.empty(2 * size, dtype=np.int64)
+        self.columns = dict((field, np.empty(2 * size, dtype=dtypes[field])) for field in fields)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, stamp, columns, position):
+        if self.end == 2 * self.size:
+            self.stamps[:self.size] = self.stamps[self.size:]
+            for field in self.fields:
+                self.columns[field][:self.size] = self.columns[field][self.size:]
+            self.end = self.size
+        self.stamps[self.end] = stamp
+        for field in self.fields:
+            self.columns[field][self.end] = columns[field][position]
+        self.end += 1
+        self.start = max(self.end - self.size, 0)
+
+    def frame(self, n=1):
+        start = max(self.end - n, self.start)
+        return pd.DataFrame(dict((field, self.columns[field][start:self.end]) for field in self.fields),
+                            index=pd.DatetimeIndex(self.stamps[start:self.end]), columns=self.fields)
 
 
 class DataHandler(object):
     """
     Basic Data  Handler structure to provide an interface for accessing live or simulated market data
     """
-    def __init__(self, queue):
+    def __init__(self, queue, clock=None):
+        """
+        clock - SimulatedClock moved to every new bar, None for live data
+        """
         self.queue = queue
+        self.clock = clock
+        self.indicators = {}
+        self.symbol_indicators = {}
+        self.warm_indicators = {}
 
     def get_latest_data(self, symbol, n=1):
         """
@@ -22,13 +103,56 @@ class DataHandler(object):
         """
         raise NotImplementedError
 
+    def get_latest_bar(self, symbol='SPY'):
+        """
+        latest bar of symbol as dict field: value - cheap alternative to get_latest_data for a single bar
+        """
+        data = self.get_latest_data(symbol, 1)
+        return dict((field, data[field].iloc[-1]) for field in data.columns)
+
+    def get_history(self, symbol=None):
+        """
+        bars visible to the strategy as (int64 timestamps, dict of column arrays, first row, last row + 1)
+        """
+        raise NotImplementedError
+
+    def register_indicator(self, name, indicator, symbol=None):
+        """
+        registers an incremental indicator (see indicators.py) under name
+        the indicator is warmed up on the history and then updated with every new bar
+        if an already warmed up indicator was handed to the data handler under name, that one is used instead
+        symbol is only used by multi symbol data handlers
+        """
+        if name in self.warm_indicators:
+            indicator = self.warm_indicators[name]
+        else:
+            stamps, columns, start, end = self.get_history(symbol)
+            indicator.warmup(stamps, columns, start, end)
+        self.indicators[name] = indicator
+        self.symbol_indicators.setdefault(None, []).append(indicator)
+        return indicator
+
+    def tick(self, timestamp):
+        """
+        moves the clock to the timestamp of the new bar
+        """
+        if self.clock is not None:
+            self.clock.set(timestamp)
+
+    def update_indicators(self, stamp, columns, position, symbol=None):
+        for indicator in self.symbol_indicators.get(symbol, ()):
+            indicator.update(stamp, columns, position)
+
 
     def read_data(self, workfile='workfile_tmp.p'):
         """
         Initializes database from workfile
-        Standard pickle
+        Standard pickle or BarStore directory
         """
-        self.data = pickle.load(open(workfile, 'rb'))
+        if os.path.isdir(workfile):
+            self.data = BarStore(workfile).frame()
+        else:
+            self.data = pickle.load(open(workfile, 'rb'))
 
     def refresh_data(self):
         raise NotImplementedError
@@ -36,44 +160,283 @@ class DataHandler(object):
 
 class BacktestDataHandler(DataHandler):
     """
-    Basic Data  Handler structure to provide an interface for accessing live or simulated market data
+    Backtest Data Handler - loads the full history once into column arrays and advances a cursor per bar
+    data before the cursor is visible to the strategy, the bar at the cursor is the execution bar
     """
 
-    def __init__(self, queue, workfile='workfile_tmp.p', split=0.1):
-        super(BacktestDataHandler, self).__init__(queue)
+    def __init__(self, queue, workfile='workfile_tmp.p', split=0.1, start=None, end=None, test_bars=None,
+                 indicators=None, clock=None):
+        """
+        Parameters:
+        split - out-of-sample fraction
+        start, end - only rows start..end-1 of the workfile are used
+        test_bars - number of out-of-sample bars, overrides split
+        indicators - dict name: indicator already warmed up to the first out-of-sample bar
+        clock - SimulatedClock moved to every new bar
+        """
+        super(BacktestDataHandler, self).__init__(queue, clock)
         self.read_data(workfile)
-        splitno = int(floor(len(self.data) * (1 - split)))
-        self.btest = self.data.iloc[splitno + 1:]
-        self.execution_data = self.data.iloc[splitno]
-        self.data = self.data.iloc[:splitno]
+        if start is not None or end is not None:
+            self.stamps = self.stamps[start:end]
+            self.columns = dict((field, self.columns[field][start:end]) for field in self.fields)
+        self.length = len(self.stamps)
+        if test_bars is None:
+            self.cursor = int(floor(self.length * (1 - split)))
+        else:
+            self.cursor = self.length - test_bars
+        if indicators is not None:
+            self.warm_indicators = indicators
 
     def get_latest_data(self, symbol='SPY', n=1):
         """
-        get latest marketdata for symbol and create MarketEvent if new data available
+        get latest marketdata for symbol - DataFrame of the last n bars before the cursor
         """
-        return self.data.ix[-n:]
+        start = max(self.cursor - n, 0)
+        return pd.DataFrame(dict((field, self.columns[field][start:self.cursor]) for field in self.fields),
+                            index=pd.DatetimeIndex(self.stamps[start:self.cursor]), columns=self.fields)
+
+    def get_latest_bar(self, symbol='SPY'):
+        return dict((field, self.columns[field][self.cursor - 1]) for field in self.fields)
 
     def get_execution_data(self, symbol='SPY'):
         """
         get latest bar - only for backtest execution simulation
         """
-        return self.execution_data
+        return dict((field, self.columns[field][self.cursor]) for field in self.fields)
+
+    def get_execution_time(self, symbol='SPY'):
+        """
+        timestamp (int64 ns) of the execution bar
+        """
+        return self.stamps[self.cursor]
+
+    def get_history(self, symbol='SPY'):
+        return self.stamps, self.columns, 0, self.cursor
 
     def data_event(self):
-        try:
-            self.data = self.data.append(self.execution_data)
-            self.execution_data = self.btest.ix[0]
-            self.btest = self.btest.ix[1:]
-            self.queue.put(MarketDataEvent(self.data.index[-1], self.data.close[-1]))
-        except IndexError:
+        if self.cursor + 1 >= self.length:
             self.queue.put(StartStopEvent())
+            return
+        self.cursor += 1
+        self.update_indicators(self.stamps[self.cursor - 1], self.columns, self.cursor - 1)
+        lasttimestamp = pd.Timestamp(self.stamps[self.cursor - 1])
+        self.tick(lasttimestamp)
+        self.queue.put(MarketDataEvent(lasttimestamp, self.columns['close'][self.cursor - 1]))
 
     def read_data(self, workfile='workfile_tmp.p'):
         """
         Initializes database from workfile
-        Standard pickle
+        Standard pickle, stored as int64 timestamps and one array per column
+        a BarStore directory is memory-mapped instead of loaded
+        """
+        self.fields, self.stamps, self.columns = read_columns(workfile)
+
+    def refresh_data(self):
+        pass
+
+
+class StreamingBacktestDataHandler(DataHandler):
+    """
+    Backtest Data Handler for histories larger than memory
+    reads bars in chunks from disk, the next chunks are prefetched on a background thread
+    only a bounded lookback window, the current chunk and the prefetch buffer are held in memory
+    split needs the length of the data, so the first warmup bars are used as history instead
+    """
+
+    def __init__(self, queue, workfile, warmup=1000, lookback=1000, chunksize=100000, prefetch_chunks=1,
+                 clock=None):
+        super(StreamingBacktestDataHandler, self).__init__(queue, clock)
+        self.chunks = prefetch(read_chunks(workfile, chunksize), depth=prefetch_chunks)
+        self.stamps, self.columns = next(self.chunks)
+        self.fields = sorted(self.columns)
+        self.position = 0
+        dtypes = dict((field, self.columns[field].dtype) for field in self.fields)
+        self.window = BarWindow(lookback, self.fields, dtypes)
+        for i in xrange(warmup):
+            if not self.advance():
+                break
+
+    def advance(self):
+        """
+        moves the execution bar into the lookback window, returns False if the data is exhausted
+        """
+        chunk = None
+        if self.position + 1 >= len(self.stamps):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return False
+        self.window.append(self.stamps[self.position], self.columns, self.position)
+        if chunk is None:
+            self.position += 1
+        else:
+            self.stamps, self.columns = chunk
+            self.position = 0
+        return True
+
+    def get_latest_data(self, symbol='SPY', n=1):
+        """
+        get latest marketdata for symbol - DataFrame of the last n bars, at most lookback
+        """
+        return self.window.frame(n)
+
+    def get_latest_bar(self, symbol='SPY'):
+        return dict((field, self.window.columns[field][self.window.end - 1]) for field in self.fields)
+
+    def get_execution_data(self, symbol='SPY'):
         """
-        self.data = pickle.load(open(workfile, 'rb'))
+        get latest bar - only for backtest execution simulation
+        """
+        return dict((field, self.columns[field][self.position]) for field in self.fields)
+
+    def get_execution_time(self, symbol='SPY'):
+        """
+        timestamp (int64 ns) of the execution bar
+        """
+        return self.stamps[self.position]
+
+    def get_history(self, symbol='SPY'):
+        return self.window.stamps, self.window.columns, self.window.start, self.window.end
+
+    def data_event(self):
+        if not self.advance():
+            self.queue.put(StartStopEvent())
+            return
+        self.update_indicators(self.window.stamps[self.window.end - 1], self.window.columns, self.window.end - 1)
+        lasttimestamp = pd.Timestamp(self.window.stamps[self.window.end - 1])
+        self.tick(lasttimestamp)
+        self.queue.put(MarketDataEvent(lasttimestamp, self.window.columns['close'][self.window.end - 1]))
+
+    def refresh_data(self):
+        pass
+
+
+class MultiSymbolDataHandler(DataHandler):
+    """
+    Backtest Data Handler for several symbols - streams the bar series of all symbols in timestamp order
+    through a k-way heap merge and emits one MarketDataEvent per timestamp with the closes of all updated symbols
+    every symbol keeps its own column arrays and cursor, like BacktestDataHandler
+    """
+
+    def __init__(self, queue, workfiles, split=0.1, start=None, indicators=None, clock=None, primary=None):
+        """
+        Parameters:
+        workfiles - dict or list of (symbol, workfile) (pickle or BarStore directory), the order is kept
+        primary - default symbol of the getters, its close is MarketDataEvent.close and its bars define split,
+                  default SPY if it is in workfiles, else the first symbol
+        split - out-of-sample fraction of the primary symbol, used if start is None
+        start - timestamp of the first streamed bar, earlier bars are history
+        indicators - dict name: indicator already warmed up to start, e.g. a walk-forward snapshot
+        """
+        super(MultiSymbolDataHandler, self).__init__(queue, clock)
+        if indicators is not None:
+            self.warm_indicators = indicators
+        workfiles = workfiles.items() if isinstance(workfiles, dict) else list(workfiles)
+        self.symbols = [symbol for symbol, workfile in workfiles]
+        if primary is None:
+            primary = 'SPY' if 'SPY' in self.symbols else self.symbols[0]
+        elif primary not in self.symbols:
+            raise ValueError("primary symbol %s has no workfile" % primary)
+        self.primary = primary
+        self.fields = {}
+        self.stamps = {}
+        self.columns = {}
+        for symbol, workfile in workfiles:
+            self.fields[symbol], self.stamps[symbol], self.columns[symbol] = read_columns(workfile)
+        if start is None:
+            first = self.stamps[primary]
+            start = first[int(floor(len(first) * (1 - split)))]
+        else:
+            start = pd.Timestamp(start).value
+        self.cursors = dict((symbol, int(self.stamps[symbol].searchsorted(start))) for symbol in self.symbols)
+        self.bars = heapq.merge(*[self._stream(symbol) for symbol in self.symbols])
+        self.next_bar = next(self.bars, None)
+
+    def _stream(self, symbol):
+        """
+        (timestamp, symbol) for every bar after the cursor - the last bar is only used as execution bar
+        """
+        stamps = self.stamps[symbol]
+        for stamp in stamps[self.cursors[symbol]:len(stamps) - 1]:
+            yield stamp, symbol
+
+    def get_latest_data(self, symbol=None, n=1):
+        """
+        get latest marketdata for symbol - DataFrame of the last n bars before the symbol's cursor
+        """
+        symbol = self.primary if symbol is None else symbol
+        cursor = self.cursors[symbol]
+        start = max(cursor - n, 0)
+        fields = self.fields[symbol]
+        return pd.DataFrame(dict((field, self.columns[symbol][field][start:cursor]) for field in fields),
+                            index=pd.DatetimeIndex(self.stamps[symbol][start:cursor]), columns=fields)
+
+    def get_latest_bar(self, symbol=None):
+        symbol = self.primary if symbol is None else symbol
+        cursor = self.cursors[symbol] - 1
+        return dict((field, self.columns[symbol][field][cursor]) for field in self.fields[symbol])
+
+    def get_execution_data(self, symbol=None):
+        """
+        get next bar of symbol - only for backtest execution simulation, None if symbol has no bars left
+        """
+        symbol = self.primary if symbol is None else symbol
+        cursor = self.cursors[symbol]
+        if cursor >= len(self.stamps[symbol]):
+            return None
+        return dict((field, self.columns[symbol][field][cursor]) for field in self.fields[symbol])
+
+    def get_execution_time(self, symbol=None):
+        """
+        timestamp (int64 ns) of the next bar of symbol, None if symbol has no bars left
+        """
+        symbol = self.primary if symbol is None else symbol
+        cursor = self.cursors[symbol]
+        if cursor >= len(self.stamps[symbol]):
+            return None
+        return self.stamps[symbol][cursor]
+
+    def get_history(self, symbol=None):
+        symbol = self.primary if symbol is None else symbol
+        return self.stamps[symbol], self.columns[symbol], 0, self.cursors[symbol]
+
+    def register_indicator(self, name, indicator, symbol=None):
+        """
+        like DataHandler.register_indicator, the indicator is updated with the bars of symbol only
+        """
+        symbol = self.primary if symbol is None else symbol
+        if name in self.warm_indicators:
+            indicator = self.warm_indicators[name]
+        else:
+            stamps, columns, start, end = self.get_history(symbol)
+            indicator.warmup(stamps, columns, start, end)
+        self.indicators[name] = indicator
+        self.symbol_indicators.setdefault(symbol, []).append(indicator)
+        return indicator
+
+    def data_event(self):
+        if self.next_bar is None:
+            self.queue.put(StartStopEvent())
+            return
+        stamp = self.next_bar[0]
+        closes = {}
+        while self.next_bar is not None and self.next_bar[0] == stamp:
+            symbol = self.next_bar[1]
+            self.cursors[symbol] += 1
+            position = self.cursors[symbol] - 1
+            self.update_indicators(stamp, self.columns[symbol], position, symbol)
+            closes[symbol] = self.columns[symbol]['close'][position]
+            self.next_bar = next(self.bars, None)
+        lasttimestamp = pd.Timestamp(stamp)
+        self.tick(lasttimestamp)
+        self.queue.put(MarketDataEvent(lasttimestamp, self.latest_close(self.primary), closes=closes))
+
+    def latest_close(self, symbol):
+        """
+        close of the latest bar of symbol, also if it was not updated with the current timestamp
+        None before its first bar
+        """
+        cursor = self.cursors[symbol]
+        return self.columns[symbol]['close'][cursor - 1] if cursor > 0 else None
 
     def refresh_data(self):
         pass
@@ -84,35 +447,66 @@ class IBDataHandler(DataHandler):
     Basic Data  Handler structure to provide an interface for accessing live or simulated market data
     """
 
-    def __init__(self, queue, workfile='workfile_tmp.p', ibcon=None):
+    def __init__(self, queue, workfile='workfile_tmp.p', ibcon=None, start=None):
         super(IBDataHandler, self).__init__(queue)
-        self.read_data(workfile)
+        self.read_data(workfile, start=start)
         self.ibcon = ibcon
 
     def get_latest_data(self, symbol='SPY', n=1):
         return self.data.ix[-n:]
 
+    def get_history(self, symbol='SPY'):
+        stamps, columns = frame_columns(self.data)
+        return stamps, columns, 0, len(stamps)
+
+    def update_frame_indicators(self, newbars):
+        """
+        updates the indicators with every row of newbars
+        """
+        if self.symbol_indicators:
+            stamps, columns = frame_columns(newbars)
+            for position in xrange(len(stamps)):
+                self.update_indicators(stamps[position], columns, position)
+
     def data_event(self):
-        newdata = self.ibcon.new_bars()
+        self.add_bars(self.fetch_bars())
+
+    def fetch_bars(self):
+        """
+        requests the latest bars from IB - blocks until IB answers
+        """
+        return self.ibcon.new_bars()
+
+    def add_bars(self, newdata):
+        """
+        appends the new rows of newdata and puts a MarketDataEvent if there are any
+        """
         try:
             if newdata.index[-1] > self.data.index[-1]:
+                lastindex = self.data.index[-1]
                 self.data = self.data.combine_first(newdata)
+                self.update_frame_indicators(self.data[self.data.index > lastindex])
                 self.queue.put(MarketDataEvent(self.data.index[-1], self.data.close[-1]))
         except (IndexError, AttributeError):
             if len(self.data) == 0:
                 self.data = newdata
+                self.update_frame_indicators(self.data)
                 self.queue.put(MarketDataEvent(self.data.index[-1], self.data.close[-1]))
             else:
                 self.queue.put(ErrorEvent(msg='Index out of Bounds, data refresh failed...'))
 
-    def read_data(self, workfile=None):
+    def read_data(self, workfile=None, start=None):
         """
         Initializes database from workfile
-        Standard pickle
+        Standard pickle or BarStore directory - for a BarStore only the bars from start on are loaded
         """
         est = pytz.timezone('US/Eastern')
         cet = pytz.timezone('Europe/Berlin')
-        if workfile is not None:
+        if workfile is not None and os.path.isdir(workfile):
+            self.data = BarStore(workfile).frame(start=start)
+            if self.data.index.tz is None:
+                self.data = self.data.tz_localize(est)
+        elif workfile is not None:
             self.data = pickle.load(open(workfile, 'rb'))
             self.data = self.data.tz_localize(est)
         else:
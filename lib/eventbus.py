@@ -0,0 +1,149 @@
+__author__ = 'jph'
+
+"""
+eventbus.py provides a priority aware replacement for the scheduler Queue
+
+PriorityEventQueue - one FIFO lane per event type, get serves the lanes in priority order
+                     (STOP, ERROR, FILL, ORDER, SIGNAL, SCHEDULE, MARKET), so fills and orders do not wait
+                     behind a burst of market data
+
+Lanes can be bounded. When a bounded lane is full, put follows the policy of the event type:
+block - wait for room (only for producer threads, a handler putting into a full lane of its own
+        scheduler would wait forever)
+drop_oldest - discard the oldest queued event of the lane
+conflate - merge the new event into the newest queued one, see conflate_events
+
+Market data conflation: PriorityEventQueue(capacity={'MARKET': 1}, policy={'MARKET': 'conflate'}) keeps at most
+one queued MARKET event, a strategy that falls behind only sees the latest bar and event.skipped tells how many
+bars it missed.
+"""
+
+import time
+import threading
+from collections import deque
+from Queue import Empty, Full
+
+PRIORITIES = ('STOP', 'ERROR', 'FILL', 'ORDER', 'SIGNAL', 'SCHEDULE', 'MARKET')
+POLICIES = ('block', 'drop_oldest', 'conflate')
+
+
+def conflate_events(queued, event):
+    """
+    default conflation, the new event replaces the queued one
+    market events keep the latest close of every symbol of both events and count the skipped events
+    """
+    if event.type == 'MARKET':
+        if queued.closes is not None:
+            closes = dict(queued.closes)
+            closes.update(event.closes or {})
+            event.closes = closes
+        event.skipped += queued.skipped + 1
+    return event
+
+
+class PriorityEventQueue(object):
+    """
+    Thread safe priority event queue with the interface of Queue.Queue (put, get, empty, qsize)
+    capacity - dict event type: maximum number of queued events, other types are unbounded
+    policy - dict event type: block/drop_oldest/conflate for a full lane, default block
+    conflate - function(queued event, new event) returning the event that replaces the queued one
+    priorities - event types from highest to lowest priority, other types are served last
+    stats - per type counts of dropped and conflated events and the maximum lane depth
+    """
+
+    def __init__(self, capacity=None, policy=None, conflate=conflate_events, priorities=PRIORITIES):
+        self.capacity = {} if capacity is None else dict(capacity)
+        self.policy = {} if policy is None else dict(policy)
+        for type, name in self.policy.iteritems():
+            if name not in POLICIES:
+                raise ValueError("unknown policy %s for %s" % (name, type))
+        self.conflate = conflate
+        self.lanes = {}
+        self.order = []
+        for type in priorities:
+            self._lane(type)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.stats = {'dropped': {}, 'conflated': {}, 'max_depth': {}}
+
+    def _lane(self, type):
+        if type not in self.lanes:
+            self.lanes[type] = deque()
+            self.order.append(self.lanes[type])
+        return self.lanes[type]
+
+    def _count(self, stat, type):
+        self.stats[stat][type] = self.stats[stat].get(type, 0) + 1
+
+    def put(self, event, block=True, timeout=None):
+        with self.lock:
+            type = event.type
+            lane = self._lane(type)
+            limit = self.capacity.get(type)
+            if limit is not None and len(lane) >= limit:
+                policy = self.policy.get(type, 'block')
+                if policy == 'conflate' and lane:
+                    lane[-1] = self.conflate(lane[-1], event)
+                    self._count('conflated', type)
+                    return
+                elif policy == 'drop_oldest' and lane:
+                    lane.popleft()
+                    self.count -= 1
+                    self._count('dropped', type)
+                elif policy == 'block':
+                    self._wait(self.not_full, lambda: len(lane) < limit, block, timeout, Full)
+            lane.append(event)
+            self.count += 1
+            if len(lane) > self.stats['max_depth'].get(type, 0):
+                self.stats['max_depth'][type] = len(lane)
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.lock:
+            self._wait(self.not_empty, lambda: self.count, block, timeout, Empty)
+            for lane in self.order:
+                if lane:
+                    event = lane.popleft()
+                    break
+            self.count -= 1
+            if event.type in self.capacity:
+                self.not_full.notify_all()
+            return event
+
+    @staticmethod
+    def _wait(condition, ready, block, timeout, error):
+        if ready():
+            return
+        if not block:
+            raise error
+        if timeout is None:
+            while not ready():
+                condition.wait()
+        else:
+            end = time.time() + timeout
+            while not ready():
+                remaining = end - time.time()
+                if remaining <= 0:
+                    raise error
+                condition.wait(remaining)
+
+    def put_nowait(self, event):
+        self.put(event, block=False)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        return not self.count
+
+    def qsize(self):
+        return self.count
+
+    def depths(self):
+        """
+        dict event type: number of queued events
+        """
+        with self.lock:
+            return dict((type, len(lane)) for type, lane in self.lanes.iteritems())
@@ -0,0 +1,321 @@
+__author__ = 'jph'
+
+"""
+eventloop.py provides a single threaded cooperative event loop for the live engine
+
+EventLoop - runs callbacks, timers and generator coroutines on one thread
+Future - result that is set later, coroutines wait for it by yielding it
+Task - Future driving a coroutine
+LoopQueue - event queue whose get returns a Future
+Executor - runs blocking calls (broker requests) on worker threads, the result comes back as a Future
+
+A coroutine is a generator that yields
+a number - sleep for that many seconds on the loop clock
+a Future - wait until it is set, its result is sent back into the generator
+None - give way to other ready callbacks
+Exceptions of a Future are raised inside the waiting generator.
+call_soon and LoopQueue.put are thread safe, everything else has to be called on the loop thread,
+e.g. broker callbacks set results through loop.call_soon(future.set_result, result).
+Blocking calls must not run on the loop thread, a coroutine yields executor.submit(function, *args) instead
+and the loop keeps dispatching while the worker waits for the broker.
+While idle the loop blocks in select on a wakeup socket pair until the next timer, other threads write to it
+(sockets, because select does not take pipes on Windows).
+With a SimulatedClock the loop jumps to the next timer instead of waiting, unless executor calls are outstanding.
+"""
+
+import sys
+import heapq
+import select
+import socket
+import itertools
+import threading
+import traceback
+from Queue import Queue
+from collections import deque
+
+from lib.clock import LiveClock, SimulatedClock
+
+
+class Future(object):
+    """
+    Result of an operation that completes later
+    """
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def set_result(self, result=None):
+        if not self.done:
+            self.result = result
+            self._finish()
+
+    def set_exception(self, error):
+        """
+        error - sys.exc_info() tuple
+        """
+        if not self.done:
+            self.error = error
+            self._finish()
+
+    def _finish(self):
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+
+class Task(Future):
+    """
+    Runs a generator coroutine on the loop, set when the generator is exhausted
+    """
+
+    def __init__(self, loop, coroutine):
+        super(Task, self).__init__()
+        self.loop = loop
+        self.coroutine = coroutine
+        loop.call_soon(self.step)
+
+    def step(self, value=None, error=None):
+        try:
+            if error is None:
+                waiting = self.coroutine.send(value)
+            else:
+                waiting = self.coroutine.throw(*error)
+        except StopIteration:
+            self.set_result()
+            return
+        except Exception:
+            self.set_exception(sys.exc_info())
+            self.loop.exception_handler(self.error)
+            return
+        if isinstance(waiting, Future):
+            waiting.add_done_callback(self.wakeup)
+        elif waiting is None:
+            self.loop.call_soon(self.step)
+        else:
+            self.loop.call_later(waiting, self.step)
+
+    def wakeup(self, future):
+        self.loop.call_soon(self.step, future.result, future.error)
+
+
+def socketpair():
+    """
+    connected pair of sockets, through a loopback connection where socket.socketpair is missing (Windows)
+    """
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        server = listener.accept()[0]
+    finally:
+        listener.close()
+    return server, client
+
+
+class EventLoop(object):
+    """
+    Cooperative loop on a clock, default the wall clock
+    exception_handler - called with sys.exc_info() of failed callbacks and tasks
+    """
+
+    def __init__(self, clock=None):
+        self.clock = LiveClock() if clock is None else clock
+        self.simulated = isinstance(self.clock, SimulatedClock)
+        self.ready = deque()
+        self.timers = []
+        self.sequence = itertools.count()
+        self.wakeup_read, self.wakeup_write = socketpair()
+        self.wakeup_write.setblocking(False)
+        self.outstanding = 0
+        self.waiting = False
+        self.running = False
+        self.exception_handler = self.print_exception
+
+    @staticmethod
+    def print_exception(error):
+        traceback.print_exception(*error)
+
+    def call_soon(self, callback, *args):
+        """
+        runs callback(*args) in the next loop iteration - thread safe
+        """
+        self.ready.append((callback, args))
+        if self.waiting:
+            self.wake()
+
+    def wake(self):
+        try:
+            self.wakeup_write.send('x')
+        except socket.error:
+            pass
+
+    def call_later(self, delay, callback, *args):
+        self.call_at(self.clock.time() + delay, callback, *args)
+
+    def call_at(self, seconds, callback, *args):
+        heapq.heappush(self.timers, (seconds, next(self.sequence), callback, args))
+
+    def spawn(self, coroutine):
+        """
+        runs the generator coroutine as a Task
+        """
+        return Task(self, coroutine)
+
+    def poll(self, condition, interval=0.02, timeout=None):
+        """
+        Future set to True as soon as condition() holds, to False after timeout seconds
+        lets coroutines wait for values filled in by broker callbacks (see util.synch)
+        """
+        future = Future()
+        start = self.clock.time()
+
+        def check():
+            if condition():
+                future.set_result(True)
+            elif timeout is not None and self.clock.time() - start >= timeout:
+                future.set_result(False)
+            else:
+                self.call_later(interval, check)
+
+        self.call_soon(check)
+        return future
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            now = self.clock.time()
+            while self.timers and self.timers[0][0] <= now:
+                seconds, sequence, callback, args = heapq.heappop(self.timers)
+                self.ready.append((callback, args))
+            if not self.ready:
+                if self.simulated and self.timers and not self.outstanding:
+                    seconds, sequence, callback, args = heapq.heappop(self.timers)
+                    self.clock.sleep(seconds - now)
+                    self.ready.append((callback, args))
+                else:
+                    self.waiting = True
+                    if not self.ready and self.running:
+                        timeout = self.timers[0][0] - now if self.timers and not self.simulated else None
+                        readable = select.select([self.wakeup_read], [], [], timeout)[0]
+                        if readable:
+                            self.wakeup_read.recv(4096)
+                    self.waiting = False
+                    continue
+            for i in xrange(len(self.ready)):
+                callback, args = self.ready.popleft()
+                try:
+                    callback(*args)
+                except Exception:
+                    self.exception_handler(sys.exc_info())
+
+
+class LoopQueue(object):
+    """
+    FIFO event queue of an EventLoop, get returns a Future for the next event
+    conflate - function(queued event, new event), e.g. eventbus.conflate_events, merges a MARKET event into
+               a MARKET event at the end of the queue, so a slow strategy only sees the latest bar
+    """
+
+    def __init__(self, loop, conflate=None):
+        self.loop = loop
+        self.conflate = conflate
+        self.items = deque()
+        self.getters = deque()
+
+    def put(self, item):
+        """
+        thread safe
+        """
+        self.loop.call_soon(self._put, item)
+
+    def _put(self, item):
+        if self.getters:
+            self.getters.popleft().set_result(item)
+        elif self.conflate is not None and item.type == 'MARKET' and self.items and self.items[-1].type == 'MARKET':
+            self.items[-1] = self.conflate(self.items[-1], item)
+        else:
+            self.items.append(item)
+
+    def get(self):
+        future = Future()
+        if self.items:
+            future.set_result(self.items.popleft())
+        else:
+            self.getters.append(future)
+        return future
+
+    def empty(self):
+        return not self.items
+
+    def qsize(self):
+        return len(self.items)
+
+
+class Executor(object):
+    """
+    Worker threads for blocking calls of an EventLoop
+    workers - number of threads, with 1 the calls run one after the other in submission order
+    submit and call have to be called on the loop thread, the Futures are set on the loop thread
+    """
+
+    def __init__(self, loop, workers=1, name="executor"):
+        self.loop = loop
+        self.calls = Queue()
+        for number in xrange(workers):
+            worker = threading.Thread(target=self.work, name="%s_%d" % (name, number))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, function, *args):
+        """
+        Future of function(*args) run on a worker thread
+        """
+        return self.call(function, args)
+
+    def call(self, function, args=(), then=None):
+        """
+        like submit, then(result) runs on the loop thread before the Future is set to its return value
+        """
+        future = Future()
+        self.loop.outstanding += 1
+        self.calls.put((future, function, args, then))
+        return future
+
+    def work(self):
+        while True:
+            future, function, args, then = self.calls.get()
+            try:
+                result, error = function(*args), None
+            except Exception:
+                result, error = None, sys.exc_info()
+            self.loop.call_soon(self.finish, future, then, result, error)
+
+    def finish(self, future, then, result, error):
+        self.loop.outstanding -= 1
+        if error is None and then is not None:
+            try:
+                result = then(result)
+            except Exception:
+                error = sys.exc_info()
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
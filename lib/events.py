@@ -7,23 +7,54 @@ MarketDataEvent
 SignalEvent
 OrderEvent
 FillEvent
+
+Events are slotted records. IDs come from a process-wide counter seeded with the start time, so they are
+monotonic and do not repeat across sessions appending to the same log. The timestamp is taken from the
+event clock (set_clock) when the event is created. With latency instrumentation on (latency.enable) every event is
+stamped by the tracer on creation.
 """
 
 import datetime as dt
+import itertools
 import json
-import uuid
+import time
+
+_ids = itertools.count(int(time.time() * 1000) * 1000)
+_clock = dt.datetime.today
+_tracer = None
+
+
+def set_clock(clock):
+    """
+    Sets the function that provides event timestamps, e.g. the now method of a simulated clock
+    returns the previous one, so a scheduler can restore it after its run
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def set_tracer(tracer):
+    """
+    Sets the latency.LatencyTracer that stamps new events, None turns the stamping off
+    """
+    global _tracer
+    _tracer = tracer
 
 
 class Event(object):
     """
     Provides interfaces for all events
     """
+    __slots__ = ('timestamp', 'logged', 'id')
+    type = None
 
     def __init__(self):
-        self.timestamp = dt.datetime.today()
+        self.timestamp = _clock()
         self.logged = False
-        self.type = None
-        self.id = uuid.uuid4().int % 10000000000
+        self.id = next(_ids)
+        if _tracer is not None:
+            _tracer.created(self)
 
     def __str__(self):
         return json.dumps({'timestamp': str(self.timestamp), 'id': self.id, 'event': self.type})
@@ -33,36 +64,50 @@ class StartStopEvent(Event):
     """
     Starts/Stops asynchronous queue querying
     """
-
-    def __init__(self):
-        super(StartStopEvent, self).__init__()
-        self.type = 'STOP'
+    __slots__ = ()
+    type = 'STOP'
 
 
 class MarketDataEvent(Event):
     """
     Signals incoming new market data
     """
+    __slots__ = ('lasttimestamp', 'close', 'closes', 'skipped')
+    type = 'MARKET'
 
-    def __init__(self, lasttimestamp, close):
+    def __init__(self, lasttimestamp, close, closes=None, skipped=0):
+        """
+        Parameters:
+        lasttimestamp - timestamp of the new bar
+        close - close of the new bar
+        closes - dict symbol: close for all symbols updated at lasttimestamp (multi symbol data)
+        skipped - number of older market events conflated into this one (see eventbus.conflate_events)
+        """
         super(MarketDataEvent, self).__init__()
-        self.type = 'MARKET'
         self.lasttimestamp = lasttimestamp
         self.close = close
+        self.closes = closes
+        self.skipped = skipped
 
     def __str__(self):
-        return json.dumps({'timestamp': str(self.timestamp), 'id': self.id, 'event': self.type,
-                           'lasttimestamp': str(self.lasttimestamp), 'close': self.close})
+        output = {'timestamp': str(self.timestamp), 'id': self.id, 'event': self.type,
+                  'lasttimestamp': str(self.lasttimestamp), 'close': self.close}
+        if self.closes is not None:
+            output['closes'] = self.closes
+        if self.skipped:
+            output['skipped'] = self.skipped
+        return json.dumps(output)
 
 
 class ErrorEvent(Event):
     """
     Signals incoming new market data
     """
+    __slots__ = ('msg',)
+    type = 'ERROR'
 
     def __init__(self, msg="Error"):
         super(ErrorEvent, self).__init__()
-        self.type = 'ERROR'
         self.msg = msg
 
     def __str__(self):
@@ -73,6 +118,8 @@ class SignalEvent(Event):
     """
     Sends Signal from Strategy to Portfolio object
     """
+    __slots__ = ('side', 'leverage', 'symbol', 'limit', 'trigger', 'duration', 'parent', 'time_valid')
+    type = 'SIGNAL'
 
     def __init__(self, side, leverage, limit=None, trigger=None, symbol="SPY", duration=None, parent=None,
                  time_valid=5):
@@ -82,7 +129,6 @@ class SignalEvent(Event):
         leverage - leverage for respective side
         """
         super(SignalEvent, self).__init__()
-        self.type = 'SIGNAL'
         self.side = side
         self.leverage = leverage
         self.symbol = symbol
@@ -103,6 +149,9 @@ class OrderEvent(Event):
     """
     Sends Order from Portfolio object to Execution System
     """
+    __slots__ = ('symbol', 'order_type', 'quantity', 'side', 'limit', 'trigger', 'signalid', 'time_valid',
+                 'other_args')
+    type = 'ORDER'
 
     def __init__(self, symbol, side, order_type, quantity, limit=None, trigger=None, signalid=None, time_valid=5,
                  **kwargs):
@@ -115,7 +164,6 @@ class OrderEvent(Event):
         other order options as kwargs
         """
         super(OrderEvent, self).__init__()
-        self.type = 'ORDER'
         self.symbol = symbol
         self.order_type = order_type
         self.quantity = quantity
@@ -138,6 +186,9 @@ class FillEvent(Event):
     """
     Returns Filled Orders for Logging/Portfolio
     """
+    __slots__ = ('symbol', 'exchange', 'quantity', 'side', 'total_cost', 'orderid', 'price', 'ordereventid',
+                 'permid', 'signalid')
+    type = 'FILL'
 
     def __init__(self, symbol, exchange, quantity,
                  side, total_cost, orderid, price, ordereventid=None, permid=None, signalid=None):
@@ -152,7 +203,6 @@ class FillEvent(Event):
         orderid
         """
         super(FillEvent, self).__init__()
-        self.type = 'FILL'
         self.symbol = symbol
         self.exchange = exchange
         self.quantity = quantity
@@ -176,6 +226,8 @@ class ScheduleEvent(Event):
     """
     Returns Filled Orders for Logging/Portfolio
     """
+    __slots__ = ('cancelid', 'cancelall', 'offset', 'childevent', 'parent', 'output_childevent')
+    type = 'SCHEDULE'
 
     def __init__(self, offset=None, childevent=None, cancelid=None, cancelall=False, parent=None):
         """
@@ -183,7 +235,6 @@ class ScheduleEvent(Event):
         #todo
         """
         super(ScheduleEvent, self).__init__()
-        self.type = 'SCHEDULE'
         self.cancelid = cancelid
         self.cancelall = cancelall
         self.offset = offset
@@ -1,22 +1,36 @@
 __author__ = 'jph'
 import time
+import types
+import heapq
 import threading
-import datetime as dt
 import copy
 
-import pytz
+import pandas as pd
 
-from lib.events import SignalEvent, ErrorEvent, StartStopEvent
+from lib.events import SignalEvent, ErrorEvent, StartStopEvent, ScheduleEvent, set_clock
+from lib.clock import LiveClock, SimulatedClock
+from lib.sessions import SessionCalendar
+from lib.eventloop import LoopQueue, Future, Executor
+from lib.logwriter import LogWriter
+from lib.timerwheel import TimerService
+from lib import latency
+from lib.profiler import SchedulerProfiler
 
 
 class EventScheduler(object):
     """
     Takes an event queue and datahandler,strategy,portfolio, trader and execution
     objects and processes all events on the queue
+    clock - time source of the engine, default the wall clock, handed to the trader (trader.clock)
+            it becomes the event clock (events.set_clock) only while the scheduler runs (use_clock), so
+            constructing a scheduler does not change the timestamps of another one
     """
 
-    def __init__(self, queue, datahandler, strategy, portfolio, trader, verbose=True, inputqueue=None):
+    def __init__(self, queue, datahandler, strategy, portfolio, trader, verbose=True, inputqueue=None, clock=None):
         self.queue = queue
+        self.clock = LiveClock() if clock is None else clock
+        if hasattr(trader, 'clock'):
+            trader.clock = self.clock
         if inputqueue is None:
             self.inputqueue = self.queue
         else:
@@ -27,119 +41,477 @@ class EventScheduler(object):
         self.trader = trader
         self.verbose = verbose
         self.counter = 0
-        self.scheduled_events = {}
-        self.filled = []
-        #self.scheduled_events=[(2407416654, ErrorEvent("Error, End of scheduled Events reached"))]
+        self.skipped = 0
+        self.profiler = None
+        self.released = {}
+        self.released_limit = 64
+        self.clear_schedule()
         #self.scheduling_thread=None
 
+    def clear_schedule(self):
+        """
+        scheduled_events - min-heap of (due counter, schedule event id)
+        pending - schedule event id: (childevent, parent), cancelled ids are removed here only (lazy cancellation)
+        filled - signal ids with fills
+        released - id of a released child: (schedule event id, counter at release), only kept if the trader rests
+                   orders, their resting orders are cancelled with the schedule, filled children are removed at
+                   once, expired ones by prune_released
+        only called on the dispatching thread, other threads put a ScheduleEvent(cancelall=True)
+        """
+        self.scheduled_events = []
+        self.pending = {}
+        self.filled = set()
+        self.cancel_released()
+
+    def cancel_released(self, id=None):
+        """
+        cancels the resting orders of the released child of schedule event id, of all released children with None
+        """
+        if id is None:
+            released, self.released = self.released.keys(), {}
+        else:
+            released = [childid for childid, (scheduleid, counter) in self.released.iteritems() if scheduleid == id]
+        for childid in released:
+            self.released.pop(childid, None)
+            self.cancel_orders(signalid=childid)
+
+    def prune_released(self):
+        """
+        drops the children released before the current bar that have no resting order (filled, expired, never
+        rested), runs whenever released grew to twice its size after the last pruning
+        """
+        resting = self.trader.resting_signals()
+        for childid, (scheduleid, counter) in self.released.items():
+            if counter < self.counter and childid not in resting:
+                del self.released[childid]
+        self.released_limit = 2 * len(self.released) + 64
+
+    def cancel_orders(self, signalid=None, symbol=None):
+        """
+        cancels resting orders at the trader, if it keeps any (FakeBacktestTradingHandler.cancel_orders)
+        """
+        if hasattr(self.trader, 'cancel_orders'):
+            self.trader.cancel_orders(signalid=signalid, symbol=symbol)
+
     def schedule_events(self, event):
         if event.cancelall == True:
-            self.scheduled_events = {}
+            self.clear_schedule()
         elif event.cancelid is not None:
-            self.scheduled_events.pop(event.cancelid, None)
+            if self.pending.pop(event.cancelid, None) is None:
+                self.cancel_released(event.cancelid)
         elif (event.offset is not None) and (event.childevent is not None):
-            self.scheduled_events[event.id] = {'counter': self.counter + event.offset, 'childevent': event.childevent,
-                                               'parent': event.parent}
+            self.pending[event.id] = (event.childevent, event.parent)
+            heapq.heappush(self.scheduled_events, (self.counter + event.offset, event.id))
         else:
             self.inputqueue.put(ErrorEvent(msg='Error - wrong scheduling arguments'))
 
     def check_scheduled_events(self):
-        scheduled_events_snapshot = copy.deepcopy(self.scheduled_events)
-        for id, scheduled_event in scheduled_events_snapshot.iteritems():
-            if scheduled_event['counter'] <= self.counter:
-                if (scheduled_event['parent'] is None) or (scheduled_event['parent'] in self.filled):
-                    scheduled_event['childevent'].timestamp = dt.datetime.today()
-                    self.inputqueue.put(scheduled_event['childevent'])
-                self.scheduled_events.pop(id, None)
+        """
+        releases all due child events - cost depends on the number of due events only
+        a child whose parent signal has no fill when it is due is dropped
+        """
+        while self.scheduled_events and self.scheduled_events[0][0] <= self.counter:
+            due, id = heapq.heappop(self.scheduled_events)
+            scheduled_event = self.pending.get(id)
+            if scheduled_event is None:
+                continue
+            parent = scheduled_event[1]
+            if (parent is None) or (parent in self.filled):
+                self.release_scheduled_event(id)
+            else:
+                self.pending.pop(id, None)
+
+    def release_scheduled_event(self, id):
+        scheduled_event = self.pending.pop(id, None)
+        if scheduled_event is not None:
+            scheduled_event[0].timestamp = self.clock.now()
+            if hasattr(self.trader, 'resting_signals') and getattr(self.trader, 'resting', True):
+                if len(self.released) >= self.released_limit:
+                    self.prune_released()
+                self.released[scheduled_event[0].id] = (id, self.counter)
+            self.inputqueue.put(scheduled_event[0])
+
+    def mark_filled(self, signalid):
+        """
+        marks signalid as filled, check_scheduled_events releases its children when they are due
+        """
+        self.filled.add(signalid)
+
+    def use_clock(self):
+        """
+        makes the scheduler clock the event clock, returns the previous event clock
+        """
+        return set_clock(self.clock.now)
 
     def process_events(self):
+        self.use_clock()
         while True:
             event = self.queue.get()
-            if self.verbose:
-                print event
-            if event.type == "MARKET":
-                self.counter += 1
-                self.check_scheduled_events()
-                self.additional_market_actions()
-                self.strategy.calculate_signals()
-            elif event.type == "SIGNAL":
-                self.portfolio.get_signal(event)
-            elif event.type == "ORDER":
-                self.trader.execute_order(event)
-            elif event.type == "FILL":
-                self.filled.append(event.signalid)
-                self.portfolio.get_fill(event)
-            elif event.type == "SCHEDULE":
-                self.schedule_events(event)
-
-    def additional_market_actions(self):
+            if latency.tracer is None:
+                self.dispatch(event)
+            else:
+                latency.tracer.dispatch(self.dispatch, event)
+
+    def dispatch(self, event):
+        """
+        hands a single event to the responsible handler, returns what the handler returns
+        """
+        if self.verbose:
+            print event
+        if event.type == "MARKET":
+            self.counter += 1 + event.skipped
+            self.skipped += event.skipped
+            self.check_scheduled_events()
+            self.additional_market_actions(event)
+            return self.strategy.calculate_signals()
+        elif event.type == "SIGNAL":
+            if event.side == "CLOSE":
+                self.cancel_orders(symbol=event.symbol)
+            return self.portfolio.get_signal(event)
+        elif event.type == "ORDER":
+            return self.trader.execute_order(event)
+        elif event.type == "FILL":
+            self.mark_filled(event.signalid)
+            self.released.pop(event.signalid, None)
+            return self.portfolio.get_fill(event)
+        elif event.type == "SCHEDULE":
+            self.schedule_events(event)
+
+    def additional_market_actions(self, event):
         pass
 
+    def enable_profiling(self, sample_interval=None):
+        """
+        times every dispatch and handler call per event type until disable_profiling, returns the
+        profiler.SchedulerProfiler (report, table, write_folded)
+        sample_interval - seconds between stack samples for a flamegraph, None for no sampling
+        """
+        self.disable_profiling()
+        self.profiler = SchedulerProfiler(sample_interval)
+        self.profiler.attach(self)
+        return self.profiler
+
+    def disable_profiling(self):
+        """
+        restores the plain handlers, returns the profiler of the finished profiling or None
+        """
+        profiler, self.profiler = self.profiler, None
+        if profiler is not None:
+            profiler.detach()
+        return profiler
+
+    def market_metrics(self):
+        """
+        bars seen and bars skipped by market data conflation, a high skipped share means the strategy
+        is too slow for its bar size
+        """
+        return {'bars': self.counter, 'skipped': self.skipped,
+                'skipped_share': float(self.skipped) / self.counter if self.counter else None}
+
 
 class BacktestScheduler(EventScheduler):
-    def __init__(self, queue, datahandler, strategy, portfolio, trader, verbose=True, inputqueue=None):
+    """
+    runs on a SimulatedClock which the datahandler moves to every new bar, timers and event timestamps
+    follow the bar time
+    """
+
+    def __init__(self, queue, datahandler, strategy, portfolio, trader, verbose=True, inputqueue=None, clock=None):
+        if clock is None:
+            clock = datahandler.clock or SimulatedClock()
+        if clock.now() is None:
+            stamps, columns, start, end = datahandler.get_history()
+            if end > start:
+                clock.set(pd.Timestamp(stamps[end - 1]))
+        datahandler.clock = clock
         super(BacktestScheduler, self).__init__(queue, datahandler, strategy, portfolio, trader, verbose=verbose,
-                                                inputqueue=inputqueue)
+                                                inputqueue=inputqueue, clock=clock)
         self.old_signal = None
 
-    def additional_market_actions(self):
+    def additional_market_actions(self, event):
+        self.portfolio.timers.advance(self.clock.time())
         self.trader.update_prices(self.datahandler)
         self.portfolio.update_portfolio(self.datahandler)
 
 
+def equity_metrics(equity):
+    """
+    return and max drawdown of an equity curve (pd.Series)
+    """
+    if len(equity) == 0:
+        return {'return': None, 'max_drawdown': None}
+    drawdown = equity / equity.cummax() - 1
+    return {'return': equity.iloc[-1] / equity.iloc[0] - 1, 'max_drawdown': drawdown.min()}
+
+
+class BacktestResult(object):
+    """
+    Outcome of a SynchronousBacktestScheduler run
+    equity - netliq per bar (pd.Series indexed by bar timestamp)
+    """
+
+    def __init__(self, equity, portfolio, event_counts, elapsed):
+        self.equity = equity
+        self.netliq = portfolio.netliq
+        self.capital = portfolio.capital
+        self.positions = copy.deepcopy(portfolio.positions)
+        self.event_counts = event_counts
+        self.bars = event_counts.get("MARKET", 0)
+        self.fills = event_counts.get("FILL", 0)
+        self.elapsed = elapsed
+
+    def metrics(self):
+        """
+        compact summary of the run
+        """
+        metrics = equity_metrics(self.equity)
+        metrics.update({'bars': self.bars, 'fills': self.fills, 'netliq': self.netliq, 'elapsed': self.elapsed,
+                        'bars_per_sec': self.bars / self.elapsed if self.elapsed else None})
+        return metrics
+
+
+class SynchronousBacktestScheduler(BacktestScheduler):
+    """
+    Single threaded backtest without Queue locks or threads
+    all components have to share one util.DirectQueue, events are dispatched directly to the handlers
+    and a new bar is only requested once the queue is empty, run returns when the data is exhausted
+    verbose defaults to False, printing every event would cost more than the dispatch itself
+    """
+
+    def __init__(self, queue, datahandler, strategy, portfolio, trader, verbose=False, inputqueue=None, clock=None):
+        super(SynchronousBacktestScheduler, self).__init__(queue, datahandler, strategy, portfolio, trader,
+                                                           verbose=verbose, inputqueue=inputqueue, clock=clock)
+
+    def run(self):
+        queue = self.queue
+        datahandler = self.datahandler
+        portfolio = self.portfolio
+        stamps = []
+        equity = []
+        event_counts = {}
+        start = time.time()
+        previous_clock = self.use_clock()
+        try:
+            while True:
+                if not queue:
+                    datahandler.data_event()
+                event = queue.popleft()
+                if event.type == "STOP":
+                    break
+                event_counts[event.type] = event_counts.get(event.type, 0) + 1
+                self.dispatch(event)
+                if event.type == "MARKET":
+                    stamps.append(event.lasttimestamp)
+                    equity.append(portfolio.netliq)
+        finally:
+            set_clock(previous_clock)
+        return BacktestResult(pd.Series(equity, index=stamps), portfolio, event_counts, time.time() - start)
+
+
 class IBScheduler(EventScheduler):
-    def __init__(self, queue, datahandler, strategy, portfolio, trader, verbose=True, inputqueue=None):
+    def __init__(self, queue, datahandler, strategy, portfolio, trader, verbose=True, inputqueue=None, clock=None):
         super(IBScheduler, self).__init__(queue, datahandler, strategy, portfolio, trader, verbose=verbose,
-                                          inputqueue=inputqueue)
+                                          inputqueue=inputqueue, clock=clock)
         self.old_signal = None
 
-    def mainloop(self):
-        est = pytz.timezone('US/Eastern')
-        cet = pytz.timezone('Europe/Berlin')
+    def fire(self, kind):
+        """
+        action of a session boundary, a returned Future is waited for before the next boundary
+        """
+        if kind == 'BAR':
+            self.datahandler.data_event()
+        elif kind == 'OPEN':
+            print self.clock.now()
+            self.portfolio.update_portfolio()
+        elif kind == 'CLOSE':
+            print self.clock.now()
+            self.queue.put(SignalEvent("CLOSE", 1))
+            self.queue.put(ScheduleEvent(cancelall=True))
+            self.portfolio.timers.cancel_all()
+
+    def heartbeat(self, sessions):
+        """
+        generator over the seconds to sleep until the next boundary of the exchange sessions,
+        the boundary is fired when the generator is resumed
+        jitter - how late the boundaries were fired (seconds), missed - bars skipped after an overrun
+        """
+        clock = self.clock
+        self.jitter = {'count': 0, 'total': 0.0, 'max': 0.0, 'missed': 0}
+        boundaries = sessions.upcoming(clock.time())
+        boundary, kind = next(boundaries)
+        while True:
+            wait = boundary - clock.time()
+            if wait > 0:
+                yield wait
+            late = clock.time() - boundary
+            following = next(boundaries)
+            if kind == 'BAR' and following[0] <= clock.time():
+                self.jitter['missed'] += 1
+            else:
+                self.jitter['count'] += 1
+                self.jitter['total'] += late
+                self.jitter['max'] = max(self.jitter['max'], late)
+                pending = self.fire(kind)
+                if pending is not None:
+                    yield pending
+            boundary, kind = following
+
+    def report_error(self, error):
+        msg = ", ".join([str(x) for x in error])
+        print msg
+        self.queue.put(ErrorEvent(msg=msg))
+        self.queue.put(StartStopEvent())
+
+    def mainloop(self, sessions=None):
+        """
+        runs the heartbeat on the exchange sessions (sessions.SessionCalendar) on a thread
+        OPEN - portfolio update, BAR - new bar, CLOSE - close all positions and cancel all timed events
+        """
+        sessions = SessionCalendar() if sessions is None else sessions
+        self.use_clock()
         print "Waiting..."
 
         def heartbeat():
-            updated = False
-            try: #TODO debug raus
-                while True:
-                    jetzt = cet.localize(dt.datetime.today()).astimezone(est)
-                    week = jetzt.weekday() not in (5, 6)
-                    market_open = (jetzt.hour >= 10) | ((jetzt.hour == 9) & (jetzt.minute >= 31))
-                    market_close = jetzt.hour <= 15
-                    takt = jetzt.second == 0
-                    if week & market_open & market_close:
-                        if (jetzt.hour == 15) & (jetzt.minute >= 59):
-                            print jetzt
-                            self.queue.put(SignalEvent("CLOSE", 1))
-                            updated = False
-                            self.scheduled_events = {}
-                            self.filled = []
-                            time.sleep(61)
-                        elif (jetzt.hour == 9) & (jetzt.minute == 31) & (updated == False):
-                            print jetzt
-                            #self.datahandler.refresh_data()
-                            updated = True
-                            self.portfolio.update_portfolio()
-                            time.sleep(5)
-                        elif takt:
-                            self.datahandler.data_event()
-                            time.sleep(1)
-                        else:
-                            pass
-                    else:
-                        pass
-                    time.sleep(0.1)
+            try:
+                for wait in self.heartbeat(sessions):
+                    self.clock.sleep(wait)
             except:
                 import sys
 
-                msg = ", ".join([str(x) for x in sys.exc_info()])
-                print msg
-                self.queue.put(ErrorEvent(msg=msg))
-                self.queue.put(StartStopEvent())
+                self.report_error(sys.exc_info())
                 raise
 
-
         t = threading.Thread(target=heartbeat, name="mainloop_thread")
         t.daemon = True
         t.start()
-        #heartbeat()
\ No newline at end of file
+        #heartbeat()
+
+
+class AsyncEventScheduler(IBScheduler):
+    """
+    Live engine on a single eventloop.EventLoop instead of a thread per component
+    event dispatch, the session heartbeat, fill polling (trader.poll_fills) and logging run as coroutines,
+    queue has to be an eventloop.LoopQueue of loop and the trader is created with threaded=False
+    a handler may return a generator, it runs as a task so it can wait for broker responses
+    (yield loop.poll(...)) without holding up the dispatch of other events
+    the blocking broker calls run on executor threads: bar requests (datahandler.fetch_bars) and portfolio
+    updates on broker, order placement on orders (one worker, the order ids are taken in sequence)
+    a STOP event stops the loop
+    """
+
+    def __init__(self, queue, datahandler, strategy, portfolio, trader, loop, verbose=True, logfile=None,
+                 sessions=None):
+        super(AsyncEventScheduler, self).__init__(queue, datahandler, strategy, portfolio, trader, verbose=verbose,
+                                                  clock=loop.clock)
+        self.loop = loop
+        self.logfile = logfile
+        self.logging_queue = LoopQueue(loop)
+        self.sessions = SessionCalendar() if sessions is None else sessions
+        self.broker = Executor(loop, name="broker")
+        self.orders = Executor(loop, name="orders")
+        loop.exception_handler = self.report_error
+
+    def fire(self, kind):
+        """
+        like IBScheduler.fire, but the bar request and the portfolio update run on the broker executor
+        """
+        if kind == 'BAR':
+            if hasattr(self.datahandler, 'fetch_bars'):
+                return self.broker.call(self.datahandler.fetch_bars, then=self.datahandler.add_bars)
+            self.datahandler.data_event()
+        elif kind == 'OPEN':
+            print self.clock.now()
+            return self.broker.submit(self.portfolio.update_portfolio)
+        else:
+            return super(AsyncEventScheduler, self).fire(kind)
+
+    def dispatch(self, event):
+        """
+        like EventScheduler.dispatch, but orders are placed on the order executor (returns its Future)
+        """
+        if event.type != "ORDER":
+            return super(AsyncEventScheduler, self).dispatch(event)
+        if self.verbose:
+            print event
+        execute_order = self.trader.execute_order
+        if latency.tracer is not None:
+            execute_order = latency.tracer.wrap(execute_order)
+        return self.orders.submit(execute_order, event)
+
+    def check_call(self, future):
+        """
+        reports the error of an executor call nobody waits for
+        """
+        if future.error is not None:
+            self.report_error(future.error)
+
+    def process_events(self):
+        while True:
+            event = yield self.queue.get()
+            if self.logfile is not None:
+                self.logging_queue.put(event)
+            if event.type == "STOP":
+                if self.logfile is None:
+                    self.loop.stop()
+                else:
+                    self.logging_queue.put(None)
+                return
+            if latency.tracer is None:
+                handler = self.dispatch(event)
+            else:
+                handler = latency.tracer.dispatch(self.dispatch, event)
+            if isinstance(handler, types.GeneratorType):
+                self.loop.spawn(handler)
+            elif isinstance(handler, Future):
+                handler.add_done_callback(self.check_call)
+
+    def log_events(self):
+        """
+        appends all events to logfile, flushed in batches and by flush_log when no event arrives
+        None drains the log and stops the loop
+        """
+        self.writer = LogWriter(self.logfile)
+        self.loop.spawn(self.flush_log(self.writer))
+        while True:
+            event = yield self.logging_queue.get()
+            if event is None:
+                self.writer.close()
+                self.loop.stop()
+                return
+            self.writer.write(event)
+
+    def flush_log(self, writer):
+        """
+        writes the lines buffered for flush_interval seconds
+        """
+        while not writer.file.closed:
+            yield writer.flush_interval
+            writer.flush_if_due()
+
+    def advance_timers(self):
+        """
+        drives the portfolio TimerWheel on the loop clock
+        """
+        timers = self.portfolio.timers
+        while True:
+            timers.advance(self.clock.time())
+            yield timers.resolution
+
+    def run(self):
+        """
+        runs the engine until a STOP event arrives
+        the portfolio timers are advanced on the loop unless they are a TimerService with an own thread
+        """
+        previous_clock = self.use_clock()
+        print "Waiting..."
+        self.loop.spawn(self.process_events())
+        self.loop.spawn(self.heartbeat(self.sessions))
+        if self.logfile is not None:
+            self.loop.spawn(self.log_events())
+        if hasattr(self.trader, 'poll_fills'):
+            self.loop.spawn(self.trader.poll_fills())
+        if not isinstance(self.portfolio.timers, TimerService):
+            self.loop.spawn(self.advance_timers())
+        try:
+            self.loop.run_forever()
+        finally:
+            set_clock(previous_clock)
@@ -12,6 +12,7 @@ import pytz
 import pandas as pd
 
 from util import synch
+from latency import monotonic
 
 
 class IBInterface(object):
@@ -213,6 +214,8 @@ class IBInterface(object):
     def orderstatus_handler(self, msg):
         if msg.orderId not in self.orders:
             self.orders[msg.orderId] = {}
+        if msg.status == "Filled" and self.orders[msg.orderId].get('status') != "Filled":
+            self.orders[msg.orderId]['filledtime'] = monotonic()
         self.orders[msg.orderId]['status'] = msg.status
         self.orders[msg.orderId]['filled'] = msg.filled
         self.orders[msg.orderId]['remaining'] = msg.remaining
@@ -0,0 +1,254 @@
+__author__ = 'jph'
+
+"""
+indicators.py provides incremental indicators which are registered at a data handler
+
+RollingMean
+RollingStd
+EMA
+RollingMax
+RollingMin
+ATR
+VWAP
+ZScore
+
+The data handler calls update with every new bar, each update is O(1).
+Strategies only read indicator.value, which is None until enough bars were seen.
+"""
+
+import datetime as dt
+from collections import deque
+from math import sqrt
+
+import pytz
+
+NS_PER_HOUR = 60 * 60 * 10 ** 9
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+
+class Indicator(object):
+    """
+    Provides interfaces for all indicators
+    """
+
+    def __init__(self, field='close'):
+        self.field = field
+        self.value = None
+
+    def update(self, stamp, columns, position):
+        """
+        adds the bar at position of the column arrays
+        """
+        raise NotImplementedError
+
+    def warmup(self, stamps, columns, start, end):
+        """
+        feeds the history rows start..end-1
+        """
+        for position in xrange(start, end):
+            self.update(stamps[position], columns, position)
+
+
+class RollingMean(Indicator):
+    """
+    Mean over the last window bars
+    """
+
+    def __init__(self, window, field='close'):
+        super(RollingMean, self).__init__(field)
+        self.window = window
+        self.values = deque()
+        self.total = 0.0
+
+    def update(self, stamp, columns, position):
+        x = float(columns[self.field][position])
+        self.values.append(x)
+        self.total += x
+        if len(self.values) > self.window:
+            self.total -= self.values.popleft()
+        if len(self.values) == self.window:
+            self.value = self.total / self.window
+
+
+class RollingStd(Indicator):
+    """
+    Sample standard deviation over the last window bars, also keeps the rolling mean
+    Welford's update (running mean and sum of squared deviations) instead of sum(x^2) - sum * mean, which
+    cancels large sums, both are recomputed from the window every window bars so rounding does not build up
+    """
+
+    def __init__(self, window, field='close'):
+        super(RollingStd, self).__init__(field)
+        self.window = window
+        self.values = deque()
+        self.average = 0.0
+        self.squares = 0.0
+        self.replaced = 0
+        self.mean = None
+
+    def update(self, stamp, columns, position):
+        x = float(columns[self.field][position])
+        self.values.append(x)
+        if len(self.values) > self.window:
+            old = self.values.popleft()
+            self.replaced += 1
+            if self.replaced == self.window:
+                self.replaced = 0
+                self.average = sum(self.values) / self.window
+                self.squares = sum((value - self.average) ** 2 for value in self.values)
+            else:
+                average = self.average + (x - old) / self.window
+                self.squares += (x - old) * (x - average + old - self.average)
+                self.average = average
+        else:
+            delta = x - self.average
+            self.average += delta / len(self.values)
+            self.squares += delta * (x - self.average)
+        if len(self.values) == self.window and self.window > 1:
+            self.mean = self.average
+            self.value = sqrt(max(self.squares, 0.0) / (self.window - 1))
+
+
+class EMA(Indicator):
+    """
+    Exponential moving average with alpha = 2 / (span + 1), seeded with the first bar
+    """
+
+    def __init__(self, span, field='close'):
+        super(EMA, self).__init__(field)
+        self.alpha = 2.0 / (span + 1)
+
+    def update(self, stamp, columns, position):
+        x = float(columns[self.field][position])
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+
+
+class RollingMax(Indicator):
+    """
+    Maximum over the last window bars - monotonic deque of (bar number, value)
+    """
+
+    def __init__(self, window, field='high'):
+        super(RollingMax, self).__init__(field)
+        self.window = window
+        self.candidates = deque()
+        self.count = 0
+
+    def better(self, x, y):
+        return x >= y
+
+    def update(self, stamp, columns, position):
+        x = columns[self.field][position]
+        while self.candidates and self.better(x, self.candidates[-1][1]):
+            self.candidates.pop()
+        self.candidates.append((self.count, x))
+        if self.candidates[0][0] <= self.count - self.window:
+            self.candidates.popleft()
+        self.count += 1
+        if self.count >= self.window:
+            self.value = self.candidates[0][1]
+
+
+class RollingMin(RollingMax):
+    """
+    Minimum over the last window bars - monotonic deque of (bar number, value)
+    """
+
+    def __init__(self, window, field='low'):
+        super(RollingMin, self).__init__(window, field)
+
+    def better(self, x, y):
+        return x <= y
+
+
+class ATR(Indicator):
+    """
+    Average true range - mean of the true range over the last window bars
+    """
+
+    def __init__(self, window=14):
+        super(ATR, self).__init__(field=None)
+        self.window = window
+        self.ranges = deque()
+        self.total = 0.0
+        self.last_close = None
+
+    def update(self, stamp, columns, position):
+        high = float(columns['high'][position])
+        low = float(columns['low'][position])
+        if self.last_close is None:
+            true_range = high - low
+        else:
+            true_range = max(high, self.last_close) - min(low, self.last_close)
+        self.last_close = float(columns['close'][position])
+        self.ranges.append(true_range)
+        self.total += true_range
+        if len(self.ranges) > self.window:
+            self.total -= self.ranges.popleft()
+        if len(self.ranges) == self.window:
+            self.value = self.total / self.window
+
+
+class VWAP(Indicator):
+    """
+    Volume weighted average of the typical price (high + low + close) / 3, reset every session (day)
+    tz - None for naive bar timestamps in exchange time (the workfiles, see clock.SimulatedClock), the timezone
+         of the exchange for utc timestamps, the session day is then the day in tz
+    """
+
+    def __init__(self, tz=None):
+        super(VWAP, self).__init__(field=None)
+        self.tz = None if tz is None else pytz.timezone(tz)
+        self.hour = None
+        self.offset = 0
+        self.day = None
+        self.turnover = 0.0
+        self.volume = 0.0
+
+    def session_day(self, stamp):
+        """
+        day number of the session of stamp, the utc offset of tz is only looked up once per hour
+        """
+        if self.tz is not None:
+            hour = stamp // NS_PER_HOUR
+            if hour != self.hour:
+                self.hour = hour
+                utc = dt.datetime.utcfromtimestamp(hour * 3600)
+                self.offset = int(self.tz.utcoffset(utc).total_seconds()) * 10 ** 9
+        return (stamp + self.offset) // NS_PER_DAY
+
+    def update(self, stamp, columns, position):
+        day = self.session_day(stamp)
+        if day != self.day:
+            self.day = day
+            self.turnover = 0.0
+            self.volume = 0.0
+        volume = float(columns['volume'][position])
+        price = (columns['high'][position] + columns['low'][position] + columns['close'][position]) / 3.0
+        self.turnover += price * volume
+        self.volume += volume
+        if self.volume > 0:
+            self.value = self.turnover / self.volume
+
+
+class ZScore(Indicator):
+    """
+    Distance of the latest value from the rolling mean in rolling standard deviations
+    """
+
+    def __init__(self, window, field='close'):
+        super(ZScore, self).__init__(field)
+        self.std = RollingStd(window, field)
+
+    def update(self, stamp, columns, position):
+        """
+        value is 0 while the window is flat (zero standard deviation)
+        """
+        self.std.update(stamp, columns, position)
+        if self.std.value:
+            self.value = (columns[self.field][position] - self.std.mean) / self.std.value
+        elif self.std.value is not None:
+            self.value = 0.0
@@ -0,0 +1,182 @@
+__author__ = 'jph'
+
+"""
+journal.py provides an append-only binary event journal
+
+file layout:
+header - magic, version, record size (HEADER_SIZE bytes)
+records - one fixed-size record per event: type code, id, timestamp, then the fields of the event type
+          the closes of a multi symbol MarketDataEvent follow as one CLOSE record per symbol with the id and
+          timestamp of the MARKET record
+
+All records have the same size, so a journal is read as one memory-mapped array and every event type is
+decoded with a numpy dtype of that record size - no per-event parsing.
+Timestamps are wall-clock microseconds (timezone dropped), missing ints are -1, missing floats NaN.
+
+A sidecar index (<journal>.idx) stores (record number, timestamp) every INDEX_STRIDE records for time range reads.
+"""
+
+import os
+import struct
+import calendar
+
+import numpy as np
+
+MAGIC = 'JPEVJRN1'
+VERSION = 1
+HEADER = struct.Struct('<8sHH4x')
+HEADER_SIZE = HEADER.size
+RECORD_SIZE = 128
+INDEX_STRIDE = 1024
+NULL_INT = -1
+
+CODES = {'OTHER': 0, 'STOP': 1, 'MARKET': 2, 'SIGNAL': 3, 'ORDER': 4, 'FILL': 5, 'SCHEDULE': 6, 'ERROR': 7,
+         'CLOSE': 8}
+TYPES = dict((code, type) for type, code in CODES.iteritems())
+
+COMMON = [('code', 'B'), ('id', 'q'), ('timestamp', 'q')]
+FIELDS = {
+    'OTHER': [],
+    'STOP': [],
+    'MARKET': [('lasttimestamp', 'q'), ('close', 'd'), ('skipped', 'q')],
+    'SIGNAL': [('symbol', '8s'), ('side', '8s'), ('leverage', 'd'), ('limit', 'd'), ('trigger', 'd'),
+               ('duration', 'd'), ('parent', 'q'), ('time_valid', 'd')],
+    'ORDER': [('symbol', '8s'), ('side', '8s'), ('order_type', '8s'), ('quantity', 'q'), ('limit', 'd'),
+              ('trigger', 'd'), ('signalid', 'q'), ('time_valid', 'd')],
+    'FILL': [('symbol', '8s'), ('side', '8s'), ('exchange', '8s'), ('quantity', 'q'), ('total_cost', 'd'),
+             ('orderid', 'q'), ('price', 'd'), ('ordereventid', 'q'), ('permid', 'q'), ('signalid', 'q')],
+    'SCHEDULE': [('cancelid', 'q'), ('cancelall', 'q'), ('offset', 'd'), ('parent', 'q'), ('childevent', 'q')],
+    'ERROR': [('msg', '96s')],
+    'CLOSE': [('symbol', '8s'), ('close', 'd')],
+}
+ATTRIBUTES = {'childevent': 'output_childevent'}
+
+
+def _layout(fields):
+    """
+    struct and numpy dtype with the same offsets for a list of (name, struct code)
+    the type code is padded to 8 bytes, every other field is 8 byte aligned
+    """
+    names, formats, offsets = [], [], []
+    fmt = '<'
+    offset = 0
+    for name, code in COMMON + fields:
+        size = struct.calcsize('<' + code)
+        names.append(name)
+        formats.append({'B': 'u1', 'q': '<i8', 'd': '<f8'}.get(code, 'S%d' % size))
+        offsets.append(offset)
+        fmt += code
+        offset += size
+        if name == 'code':
+            fmt += '7x'
+            offset += 7
+    assert offset <= RECORD_SIZE
+    fmt += '%dx' % (RECORD_SIZE - offset)
+    return struct.Struct(fmt), np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                                         'itemsize': RECORD_SIZE})
+
+
+LAYOUTS = dict((type, _layout(fields)) for type, fields in FIELDS.iteritems())
+
+
+def _micros(timestamp):
+    if timestamp is None:
+        return NULL_INT
+    if getattr(timestamp, 'tzinfo', None) is not None:
+        timestamp = timestamp.replace(tzinfo=None)
+    return calendar.timegm(timestamp.timetuple()) * 1000000 + timestamp.microsecond
+
+
+def _value(value, code):
+    if code == 'q':
+        return NULL_INT if value is None else int(value)
+    elif code == 'd':
+        return float('nan') if value is None else float(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '' if value is None else str(value)
+
+
+class EventJournal(object):
+    """
+    Append-only writer, one fixed-size record per event
+    """
+
+    def __init__(self, path):
+        """
+        appends to an existing journal, the size is taken from the file system because tell() of a file
+        opened for appending is 0 until the first write on Windows
+        """
+        self.path = path
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.file = open(path, 'ab')
+        if size == 0:
+            self.file.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+            size = HEADER_SIZE
+        self.records = (size - HEADER_SIZE) // RECORD_SIZE
+        self.index = open(path + '.idx', 'ab')
+
+    def write(self, event):
+        type = event.type if event.type in LAYOUTS else 'OTHER'
+        packer = LAYOUTS[type][0]
+        timestamp = _micros(event.timestamp)
+        values = [CODES[type], event.id, timestamp]
+        for name, code in FIELDS[type]:
+            value = getattr(event, ATTRIBUTES.get(name, name))
+            values.append(_micros(value) if name == 'lasttimestamp' else _value(value, code))
+        self._append(packer.pack(*values), timestamp)
+        if type == 'MARKET' and event.closes:
+            packer = LAYOUTS['CLOSE'][0]
+            for symbol in sorted(event.closes):
+                self._append(packer.pack(CODES['CLOSE'], event.id, timestamp, _value(symbol, '8s'),
+                                         _value(event.closes[symbol], 'd')), timestamp)
+
+    def _append(self, record, timestamp):
+        if self.records % INDEX_STRIDE == 0:
+            self.index.write(struct.pack('<qq', self.records, timestamp))
+        self.file.write(record)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+def read_journal(path, types=None, start=None, end=None):
+    """
+    Decodes a journal into one structured array (typed columns) per event type
+    types - event types to decode, default all
+    start, end - optional datetime range, resolved with the sidecar index
+    """
+    with open(path, 'rb') as journal:
+        magic, version, record_size = HEADER.unpack(journal.read(HEADER_SIZE))
+    if magic != MAGIC or record_size != RECORD_SIZE:
+        raise ValueError('Not an event journal: %s' % path)
+    records = (os.path.getsize(path) - HEADER_SIZE) // RECORD_SIZE
+    first, last = 0, records
+    if (start is not None or end is not None) and os.path.exists(path + '.idx'):
+        index = np.fromfile(path + '.idx', dtype='<i8').reshape(-1, 2)
+        if start is not None:
+            i = np.searchsorted(index[:, 1], _micros(start), side='left') - 1
+            first = int(index[i, 0]) if i >= 0 else 0
+        if end is not None:
+            i = np.searchsorted(index[:, 1], _micros(end), side='right')
+            last = int(index[i, 0]) if i < len(index) else records
+    output = {}
+    if records == 0 or last <= first:
+        return dict((type, np.empty(0, dtype=LAYOUTS[type][1])) for type in (types or FIELDS))
+    codes = np.memmap(path, dtype=LAYOUTS['OTHER'][1], mode='r', offset=HEADER_SIZE, shape=(records,))
+    selected = slice(first, last)
+    for type in (types or FIELDS):
+        rows = np.memmap(path, dtype=LAYOUTS[type][1], mode='r', offset=HEADER_SIZE, shape=(records,))[selected]
+        decoded = rows[codes['code'][selected] == CODES[type]]
+        if start is not None:
+            decoded = decoded[decoded['timestamp'] >= _micros(start)]
+        if end is not None:
+            decoded = decoded[decoded['timestamp'] <= _micros(end)]
+        output[type] = np.array(decoded)
+    return output
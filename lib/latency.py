@@ -0,0 +1,338 @@
+__author__ = 'jph'
+
+"""
+latency.py provides the latency instrumentation of the event pipeline
+
+monotonic - high resolution monotonic seconds (clock_gettime(CLOCK_MONOTONIC) through ctypes, time.time if
+            it is not available)
+Histogram - HDR style log-linear latency histogram, constant memory and cost per value
+LatencyTracer - stamps events when they are created, enqueued (QueuePreprocessor hands them to the scheduler),
+                dequeued and handled and keeps one Histogram per stage
+
+Instrumentation is off until enable() is called, every hook is a single check of latency.tracer then.
+
+Causality: every event has an origin, the time the chain of events it belongs to started. Events created while
+an event is dispatched inherit its origin, so the signals and orders of a bar carry the creation time of its
+MarketDataEvent (IBDataHandler.data_event). Fills get the time IB reported the order as Filled
+(IBInterface.orderstatus_handler). Signals and orders are also remembered by id, a fill finds them through
+signalid and ordereventid.
+
+stages (seconds):
+preprocess.<TYPE> - created to enqueued
+queue.<TYPE> - enqueued (created without QueuePreprocessor) to dequeued
+handle.<TYPE> - dequeued to handled
+origin.<TYPE> - origin to handled, origin.FILL is order status Filled to the fill reaching the portfolio
+bar_to_place_order - bar to the IBInterface.place_order call
+status_to_fill_event - order status Filled to the FillEvent
+order_to_fill, bar_to_fill - dispatch of the order (ordereventid) and origin of the signal (signalid) to the fill
+
+Export: the histograms are appended as one json line to path every interval seconds and at shutdown (atexit).
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import ctypes
+import ctypes.util
+import datetime as dt
+
+import events
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _monotonic():
+    """
+    returns the monotonic clock function of the platform
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            class timespec(ctypes.Structure):
+                _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+            library = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+            clock_gettime = library.clock_gettime
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            spec = timespec()
+            reference = ctypes.byref(spec)
+            CLOCK_MONOTONIC = 1
+
+            def monotonic():
+                clock_gettime(CLOCK_MONOTONIC, reference)
+                return spec.tv_sec + spec.tv_nsec * 1e-9
+
+            monotonic()
+            return monotonic
+        except (OSError, AttributeError, TypeError):
+            pass
+    elif sys.platform == 'win32':
+        return time.clock
+    return time.time
+
+
+monotonic = _monotonic()
+
+
+class Histogram(object):
+    """
+    HDR style histogram of latencies in seconds, values are counted in microseconds
+    sub_buckets per power of two (a power of two), the relative error of a value is below 1 / sub_buckets
+    values above 2 ** max_exponent microseconds are counted as the maximum
+    """
+
+    def __init__(self, sub_buckets=64, max_exponent=40):
+        self.sub_buckets = sub_buckets
+        self.sub_bits = sub_buckets.bit_length() - 1
+        self.limit = 2 ** max_exponent - 1
+        self.counts = [0] * self.index(self.limit) + [0]
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def index(self, value):
+        if value < 2 * self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.sub_bits - 1
+        return (shift + 1) * self.sub_buckets + (value >> shift) - self.sub_buckets
+
+    def value(self, index):
+        """
+        lowest value (microseconds) counted in the bucket index
+        """
+        if index < 2 * self.sub_buckets:
+            return index
+        shift = index // self.sub_buckets - 1
+        return (index % self.sub_buckets + self.sub_buckets) << shift
+
+    def record(self, seconds):
+        micros = min(max(int(seconds * 1e6), 0), self.limit)
+        self.counts[self.index(micros)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """
+        seconds below which percent of the values lie (upper bound of the bucket), None if it is empty
+        """
+        if not self.count:
+            return None
+        rank = max(percent / 100.0 * self.count, 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.value(index + 1) / 1e6, self.max)
+
+    def summary(self):
+        summary = {'count': self.count, 'min': self.min, 'max': self.max,
+                   'mean': self.total / self.count if self.count else None}
+        for percent in PERCENTILES:
+            summary['p%s' % str(percent).replace('.', '')] = self.percentile(percent)
+        return summary
+
+
+class LatencyTracer(object):
+    """
+    Per stage latency histograms of the event pipeline, see the module docstring
+    path - export file, None to only keep the histograms in memory
+    interval - seconds between exports, None for the export at shutdown only
+    max_tracked - maximum number of stamped events and remembered signal/order ids
+    """
+
+    def __init__(self, path="latency.json", interval=60.0, max_tracked=100000):
+        self.path = path
+        self.interval = interval
+        self.max_tracked = max_tracked
+        self.histograms = {}
+        self.stamps = {}
+        self.causes = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.exporter = None
+        self.stopped = threading.Event()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.record(seconds)
+
+    def _track(self, table, id, value):
+        """
+        remembers value by id, drops the older half of table when it is full
+        table is also popped on the dispatching thread, so the eviction works on a snapshot of the ids
+        """
+        with self.lock:
+            if len(table) >= self.max_tracked:
+                for old in sorted(table.keys())[:len(table) // 2]:
+                    table.pop(old, None)
+            table[id] = value
+
+    def created(self, event):
+        """
+        stamp of Event.__init__, the origin is the origin of the event dispatched on this thread
+        """
+        now = monotonic()
+        origin = getattr(self.local, 'origin', None)
+        self._track(self.stamps, event.id, [now, None, now if origin is None else origin])
+
+    def enqueued(self, event):
+        stamp = self.stamps.get(event.id)
+        if stamp is not None:
+            stamp[1] = monotonic()
+            self.record('preprocess.' + event.type, stamp[1] - stamp[0])
+
+    def caused(self, event, origin, stage=None):
+        """
+        sets the origin (monotonic seconds) of event, e.g. the time of the broker report that created it
+        stage - also records the latency from origin to now under this name
+        """
+        if origin is None:
+            return
+        stamp = self.stamps.get(event.id)
+        if stamp is not None:
+            stamp[2] = origin
+        if stage is not None:
+            self.record(stage, monotonic() - origin)
+
+    def stage(self, stage):
+        """
+        records the latency from the origin of the event dispatched on this thread to now
+        """
+        origin = getattr(self.local, 'origin', None)
+        if origin is not None:
+            self.record(stage, monotonic() - origin)
+
+    def wrap(self, function):
+        """
+        function with the origin of the event dispatched on this thread, for calls run on another thread
+        """
+        origin = getattr(self.local, 'origin', None)
+
+        def traced(*args, **kwargs):
+            previous = getattr(self.local, 'origin', None)
+            self.local.origin = origin
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.origin = previous
+
+        return traced
+
+    def dispatch(self, dispatch, event):
+        """
+        calls dispatch(event) and stamps the dequeue and handling of event
+        """
+        start = monotonic()
+        stamp = self.stamps.pop(event.id, None)
+        type = event.type
+        if stamp is not None:
+            self.record('queue.' + type, start - (stamp[0] if stamp[1] is None else stamp[1]))
+            origin = stamp[2]
+        else:
+            origin = start
+        if type == 'SIGNAL':
+            self._track(self.causes, event.id, origin)
+        elif type == 'ORDER':
+            self._track(self.causes, event.id, start)
+        previous = getattr(self.local, 'origin', None)
+        self.local.origin = origin
+        try:
+            return dispatch(event)
+        finally:
+            end = monotonic()
+            self.local.origin = previous
+            self.record('handle.' + type, end - start)
+            if stamp is not None:
+                self.record('origin.' + type, end - origin)
+            if type == 'FILL':
+                if event.ordereventid in self.causes:
+                    self.record('order_to_fill', end - self.causes[event.ordereventid])
+                if event.signalid in self.causes:
+                    self.record('bar_to_fill', end - self.causes[event.signalid])
+
+    def report(self):
+        """
+        dict stage: count, min, max, mean and percentiles in seconds
+        """
+        with self.lock:
+            return dict((stage, histogram.summary()) for stage, histogram in self.histograms.iteritems())
+
+    def export(self):
+        """
+        appends the report as one json line to path
+        """
+        if self.path is None:
+            return
+        line = json.dumps({'time': dt.datetime.today().isoformat(), 'pid': os.getpid(), 'stages': self.report()},
+                          sort_keys=True)
+        with open(self.path, 'a') as exportfile:
+            exportfile.write(line + "\n")
+
+    def start(self):
+        """
+        starts the periodic export and registers the export at shutdown
+        """
+        atexit.register(self.stop)
+        if self.interval is not None:
+            self.exporter = threading.Thread(target=self._export_loop, name="latency_export")
+            self.exporter.daemon = True
+            self.exporter.start()
+
+    def _export_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        """
+        stops the periodic export and exports a last time
+        """
+        if not self.stopped.is_set():
+            self.stopped.set()
+            self.export()
+
+
+tracer = None
+
+
+def enable(path="latency.json", interval=60.0, max_tracked=100000):
+    """
+    turns the instrumentation on, returns the LatencyTracer
+    """
+    global tracer
+    disable()
+    tracer = LatencyTracer(path, interval, max_tracked)
+    events.set_tracer(tracer)
+    tracer.start()
+    return tracer
+
+
+def disable():
+    """
+    turns the instrumentation off and exports the histograms
+    """
+    global tracer
+    if tracer is not None:
+        tracer.stop()
+    tracer = None
+    events.set_tracer(None)
@@ -0,0 +1,122 @@
+__author__ = 'jph'
+
+"""
+logwriter.py provides the buffered writer of the event log (log.txt)
+
+LogWriter - keeps one file handle open and writes the log lines in batches
+            a batch is written when it has batch_size lines, when flush_interval seconds passed since the
+            last write or when flush is called, the writing loop calls flush_if_due when it is idle
+            (QueuePreprocessor waits at most flush_interval for the next event) so no line stays buffered longer
+
+rotation:
+session - a new file for every day, the finished file is renamed to <logfile>.<YYYYMMDD>
+size - a new file once the log exceeds max_bytes, finished files are kept as <logfile>.1 .. <logfile>.<backups>
+"""
+
+import os
+import time
+import datetime as dt
+
+ROTATIONS = (None, 'session', 'size')
+
+
+class LogWriter(object):
+    """
+    Batched, rotating event log writer
+    the line prefix (strftime) is only formatted once per second
+    """
+
+    def __init__(self, path="log.txt", batch_size=256, flush_interval=1.0, rotate=None, max_bytes=100 * 2 ** 20,
+                 backups=10):
+        if rotate not in ROTATIONS:
+            raise ValueError("unknown rotation %s" % rotate)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer = []
+        self.second = None
+        self.prefix = None
+        self.session = None
+        self.last_flush = time.time()
+        self.stats = {'lines': 0, 'bytes': 0, 'batches': 0, 'rotations': 0, 'write_seconds': 0.0}
+        self.file = open(path, 'a')
+
+    def write(self, element, now=None):
+        """
+        buffers the log line of element, now - wall-clock time of the line
+        """
+        now = dt.datetime.today() if now is None else now
+        if self.rotate == 'session':
+            day = now.date()
+            if self.session is None:
+                self.session = day
+            elif day != self.session:
+                self.flush()
+                self.roll(self.path + '.' + self.session.strftime('%Y%m%d'))
+                self.session = day
+        second = now.replace(microsecond=0)
+        if second != self.second:
+            self.second = second
+            self.prefix = now.strftime('%m/%d-%H:%M:%S') + ","
+        self.buffer.append(self.prefix + element.type + "," + str(element) + "\n")
+        if len(self.buffer) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush_if_due(self):
+        """
+        flushes if flush_interval seconds passed since the last write, for the idle periods of the writing loop
+        """
+        if self.buffer and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        writes the buffered lines
+        """
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        batch = "".join(self.buffer)
+        self.file.write(batch)
+        self.file.flush()
+        self.stats['write_seconds'] += time.time() - self.last_flush
+        self.stats['lines'] += len(self.buffer)
+        self.stats['bytes'] += len(batch)
+        self.stats['batches'] += 1
+        self.buffer = []
+        if self.rotate == 'size' and self.file.tell() >= self.max_bytes:
+            oldest = "%s.%d" % (self.path, self.backups)
+            if os.path.exists(oldest):
+                os.remove(oldest)
+            for number in xrange(self.backups - 1, 0, -1):
+                if os.path.exists("%s.%d" % (self.path, number)):
+                    os.rename("%s.%d" % (self.path, number), "%s.%d" % (self.path, number + 1))
+            self.roll(self.path + '.1')
+
+    def roll(self, target):
+        """
+        closes the log, renames it to target and starts a new one
+        """
+        self.file.close()
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(self.path, target)
+        self.file = open(self.path, 'a')
+        self.stats['rotations'] += 1
+
+    def throughput(self):
+        """
+        stats with the write throughput in lines and bytes per second of writing
+        """
+        stats = dict(self.stats)
+        seconds = stats['write_seconds']
+        stats['lines_per_sec'] = stats['lines'] / seconds if seconds else None
+        stats['bytes_per_sec'] = stats['bytes'] / seconds if seconds else None
+        return stats
+
+    def close(self):
+        self.flush()
+        self.file.close()
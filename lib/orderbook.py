@@ -0,0 +1,146 @@
+__author__ = 'jph'
+
+"""
+orderbook.py provides the resting orders of the backtest fill simulation (FakeBacktestTradingHandler)
+
+fill_price - price at which an order fills in a bar, the fill rules of the backtest:
+    MKT - fills at the open
+    MKT with trigger (stop) - BUY if trigger < high, SELL if trigger > low, at the open if it is already through
+    LMT - BUY if limit > low, SELL if limit < high, at the open if it is already through
+OrderBook - working orders of one symbol in four min-heaps keyed by price (BUY and SELL limit ladders, BUY and
+            SELL stop triggers) and a min-heap of the GTD expiry times
+
+Every ladder fills from its top as long as the top is through the bar, so a bar costs O(log n) per fill or
+expiry and O(1) otherwise, however many orders rest. Cancelled, expired and filled orders are only removed from
+the live orders and skipped when they come up (lazy deletion), the heaps are rebuilt once they hold more than
+twice the live orders. Times are int64 nanoseconds like the bar timestamps of the datahandlers.
+"""
+
+import heapq
+
+NS_PER_MINUTE = 60 * 10 ** 9
+
+
+def fill_price(order, bar):
+    """
+    fill price of order (OrderEvent) in bar (dict with open, high, low), None if it does not fill
+    """
+    if order.order_type == "LMT":
+        if order.side == "BUY" and order.limit > bar['low']:
+            return bar['open'] if order.limit > bar['open'] else order.limit
+        if order.side == "SELL" and order.limit < bar['high']:
+            return bar['open'] if order.limit < bar['open'] else order.limit
+    elif order.order_type == "MKT":
+        if order.trigger is None:
+            return bar['open']
+        if order.side == "BUY" and order.trigger < bar['high']:
+            return bar['open'] if order.trigger < bar['open'] else order.trigger
+        if order.side == "SELL" and order.trigger > bar['low']:
+            return bar['open'] if order.trigger > bar['open'] else order.trigger
+    return None
+
+
+class OrderBook(object):
+    """
+    Working limit and stop orders of one symbol
+    time - execution bar time (ns) of the last match, a bar is only matched once
+    """
+
+    def __init__(self):
+        self.ladders = {}
+        for ladder in (('LMT', 'BUY'), ('LMT', 'SELL'), ('STP', 'BUY'), ('STP', 'SELL')):
+            self.ladders[ladder] = []
+        self.expiries = []
+        self.orders = {}
+        self.time = None
+
+    def __len__(self):
+        return len(self.orders)
+
+    @staticmethod
+    def _entry(order):
+        """
+        ladder and heap entry of order, the key sorts the order that fills first to the top
+        """
+        if order.order_type == "LMT":
+            ladder = ('LMT', order.side)
+            key = -order.limit if order.side == "BUY" else order.limit
+        else:
+            ladder = ('STP', order.side)
+            key = order.trigger if order.side == "BUY" else -order.trigger
+        return ladder, (key, order.id)
+
+    def add(self, order, time):
+        """
+        rests order (LMT or MKT with trigger) from execution bar time on
+        until time + order.time_valid minutes, None time_valid is good till cancelled
+        returns False if the order can not rest
+        """
+        if order.order_type == "LMT":
+            if order.limit is None:
+                return False
+        elif order.order_type != "MKT" or order.trigger is None:
+            return False
+        if order.time_valid is not None:
+            expiry = time + int(order.time_valid * NS_PER_MINUTE)
+            if expiry <= time:
+                return False
+            heapq.heappush(self.expiries, (expiry, order.id))
+        ladder, entry = self._entry(order)
+        heapq.heappush(self.ladders[ladder], entry)
+        self.orders[order.id] = order
+        return True
+
+    def cancel(self, id):
+        """
+        removes the order with event id, returns it or None
+        """
+        return self.orders.pop(id, None)
+
+    def cancel_signal(self, signalid):
+        """
+        removes the orders of signal signalid, returns them
+        """
+        ids = [id for id, order in self.orders.iteritems() if order.signalid == signalid]
+        return [self.orders.pop(id) for id in ids]
+
+    def cancel_all(self):
+        self.orders.clear()
+        self._compact()
+
+    def match(self, time, bar):
+        """
+        expires the orders valid before time and fills the ones bar goes through
+        returns a list of (order, fill price) in order of arrival, the filled orders are removed
+        """
+        if time == self.time:
+            return []
+        self.time = time
+        orders = self.orders
+        expiries = self.expiries
+        while expiries and expiries[0][0] <= time:
+            orders.pop(heapq.heappop(expiries)[1], None)
+        fills = []
+        for ladder, through in ((('LMT', 'BUY'), -bar['low']), (('LMT', 'SELL'), bar['high']),
+                                (('STP', 'BUY'), bar['high']), (('STP', 'SELL'), -bar['low'])):
+            heap = self.ladders[ladder]
+            while heap and heap[0][0] < through:
+                order = orders.pop(heapq.heappop(heap)[1], None)
+                if order is not None:
+                    fills.append((order, fill_price(order, bar)))
+        if len(fills) > 1:
+            fills.sort(key=lambda fill: fill[0].id)
+        if len(expiries) + sum(len(heap) for heap in self.ladders.itervalues()) > 2 * len(orders) + 64:
+            self._compact()
+        return fills
+
+    def _compact(self):
+        """
+        drops the entries of orders that are no longer live
+        """
+        live = self.orders
+        for ladder, heap in self.ladders.iteritems():
+            heap[:] = [entry for entry in heap if entry[1] in live]
+            heapq.heapify(heap)
+        self.expiries = [entry for entry in self.expiries if entry[1] in live]
+        heapq.heapify(self.expiries)
@@ -0,0 +1,112 @@
+__author__ = 'jph'
+
+"""
+pausebuffer.py provides the buffer of QueuePreprocessor for events arriving while it is paused (STOP)
+
+PauseBuffer - keeps at most capacity events in memory, older ones are spilled to a temporary file
+              (pickle protocol 2, events are slotted), replay returns them in arrival order
+
+retention per event type:
+all - every event is replayed
+latest - only the latest event is replayed after all others, MARKET events are merged with
+         eventbus.conflate_events, so the latest close of every symbol is kept and skipped counts the rest
+drop - nothing is replayed
+by default every event is kept, conflation is opt-in, e.g. PauseBuffer(retention={'MARKET': 'latest'})
+"""
+
+import time
+import tempfile
+import cPickle as pickle
+from collections import deque
+
+from eventbus import conflate_events
+
+RETENTION = {}
+RULES = ('all', 'latest', 'drop')
+
+
+class PauseBuffer(object):
+    """
+    Bounded buffer with disk spill and per type retention
+    retention - dict event type: all/latest/drop, missing types are kept (all)
+    stats - buffered, spilled, dropped and conflated events of the current pause
+    """
+
+    def __init__(self, capacity=10000, retention=RETENTION, conflate=conflate_events):
+        for type, rule in retention.iteritems():
+            if rule not in RULES:
+                raise ValueError("unknown retention %s for %s" % (rule, type))
+        self.capacity = capacity
+        self.retention = dict(retention)
+        self.conflate = conflate
+        self.spill = None
+        self.clear()
+
+    def clear(self):
+        if self.spill is not None:
+            self.spill.close()
+        self.spill = None
+        self.spilled = 0
+        self.events = deque()
+        self.latest = {}
+        self.stats = {'buffered': 0, 'spilled': 0, 'dropped': 0, 'conflated': 0}
+
+    def __len__(self):
+        return self.spilled + len(self.events) + len(self.latest)
+
+    def add(self, event):
+        rule = self.retention.get(event.type, 'all')
+        if rule == 'drop':
+            self.stats['dropped'] += 1
+        elif rule == 'latest':
+            if event.type in self.latest:
+                event = self.conflate(self.latest[event.type], event)
+                self.stats['conflated'] += 1
+            self.latest[event.type] = event
+        else:
+            self.events.append(event)
+            self.stats['buffered'] += 1
+            if len(self.events) >= self.capacity:
+                self.spill_events()
+
+    def spill_events(self):
+        """
+        moves the events held in memory to the spill file
+        """
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(prefix='pausebuffer')
+        pickler = pickle.Pickler(self.spill, 2)
+        for event in self.events:
+            pickler.dump(event)
+            pickler.clear_memo()
+        self.spilled += len(self.events)
+        self.stats['spilled'] += len(self.events)
+        self.events.clear()
+
+    def replay(self, rate=None):
+        """
+        generator over the buffered events in arrival order, the retained latest events last
+        rate - maximum events per second, None for no limit, the pacing sleeps on the consuming thread,
+               so n events take n / rate seconds in which the consumer does nothing else
+        the buffer is empty afterwards
+        """
+        start = time.time()
+        for count, event in enumerate(self._events()):
+            if rate is not None:
+                wait = start + count / float(rate) - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            yield event
+        self.clear()
+
+    def _events(self):
+        if self.spill is not None:
+            self.spill.flush()
+            self.spill.seek(0)
+            unpickler = pickle.Unpickler(self.spill)
+            for i in xrange(self.spilled):
+                yield unpickler.load()
+        while self.events:
+            yield self.events.popleft()
+        for event in sorted(self.latest.itervalues(), key=lambda event: event.id):
+            yield event
@@ -1,9 +1,9 @@
 __author__ = 'jph'
 
 from math import floor
-import threading
 
 from lib.events import OrderEvent, ErrorEvent, SignalEvent
+from lib.timerwheel import TimerWheel, TimerService
 
 
 class Portfolio(object):
@@ -11,8 +11,12 @@ class Portfolio(object):
     Interface between Strategy signals and Orders - keeps track of positions and generates orders
     """
 
-    def __init__(self, queue, max_leverage=1):
+    def __init__(self, queue, max_leverage=1, timers=None):
+        """
+        timers - TimerWheel for timed closes, default a TimerService on wall-clock time
+        """
         self.queue = queue
+        self.timers = TimerService().start() if timers is None else timers
         self.capital = 0
         self.positions = {'SPY': {'price': 0, 'position': 0}}
         self.updated = 0
@@ -96,13 +100,7 @@ class Portfolio(object):
         parent = event.id
         close_event = SignalEvent(side, leverage, limit=None, trigger=trigger, symbol=symbol, duration=None,
                                   parent=parent)
-
-        def place_close_event(event):
-            self.queue.put(event)
-
-        t = threading.Timer(timetillclose * 60, place_close_event, args=[close_event])
-        t.start()
-        return t
+        return self.timers.schedule(timetillclose * 60, self.queue.put, close_event)
 
 
 class SimPortfolio(Portfolio):
@@ -111,10 +109,12 @@ class SimPortfolio(Portfolio):
     takes kwgargs:
     capital - starting capital, float
     startportfolio - dict, starting positions
+    timers - TimerWheel for timed closes, default a wheel advanced in bar time by the BacktestScheduler
     """
 
-    def __init__(self, queue, capital=1000000.0, startportfolio=None, max_leverage=1):
-        super(SimPortfolio, self).__init__(queue=queue, max_leverage=max_leverage)
+    def __init__(self, queue, capital=1000000.0, startportfolio=None, max_leverage=1, timers=None):
+        super(SimPortfolio, self).__init__(queue=queue, max_leverage=max_leverage,
+                                           timers=TimerWheel() if timers is None else timers)
         self.capital = capital
         if startportfolio is not None:
             self.positions = startportfolio
@@ -123,7 +123,7 @@ class SimPortfolio(Portfolio):
         self.signals = {}
 
     def update_portfolio(self, datahandler):
-        spy_price = round(datahandler.get_latest_data()['close'][0], 2)
+        spy_price = round(datahandler.get_latest_bar()['close'], 2)
         self.positions['SPY']['price'] = spy_price
         self.netliq = self.capital + sum(
             (self.positions[x]['price'] * self.positions[x]['position'] for x in self.positions))
@@ -0,0 +1,182 @@
+__author__ = 'jph'
+
+"""
+profiler.py provides the opt-in profiling of the scheduler handlers
+
+SchedulerProfiler - times every dispatch and handler call of a scheduler per event type
+                    (strategy.calculate_signals, portfolio.get_signal, trader.execute_order, portfolio.get_fill,
+                    check_scheduled_events, additional_market_actions, schedule_events, mark_filled)
+StackSampler - samples the stack of the dispatching thread, write_folded writes the folded stacks of
+               flamegraph.pl / speedscope ("frame;frame;frame count" per line)
+
+The profiler replaces the handler methods of the scheduler and its components by timing wrappers on the instances
+and removes them again on detach, a scheduler without profiler runs the plain methods (no overhead).
+Calls are timed with latency.monotonic (sub-microsecond, time.clock on Windows), the durations are kept in
+latency.Histogram per (event type, handler). The event type is kept per thread, handlers called on another
+thread (orders on the order executor of AsyncEventScheduler) are recorded under type None.
+A handler returning a generator (AsyncEventScheduler) is only timed until it returns the generator.
+"""
+
+import os
+import sys
+import time
+import thread
+import threading
+
+from lib.latency import Histogram, monotonic
+
+HANDLERS = (('strategy', 'calculate_signals'), ('portfolio', 'get_signal'), ('trader', 'execute_order'),
+            ('portfolio', 'get_fill'), (None, 'check_scheduled_events'), (None, 'additional_market_actions'),
+            (None, 'schedule_events'), (None, 'mark_filled'))
+
+
+class StackSampler(object):
+    """
+    Counts the stacks of one thread every interval seconds on an own thread
+    counts - folded stack: number of samples
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+        self.thread_id = None
+        self.running = False
+        self.thread = None
+
+    def start(self, thread_id):
+        self.thread_id = thread_id
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, name="stack_sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def sample(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                folded = ";".join(reversed(stack))
+                self.counts[folded] = self.counts.get(folded, 0) + 1
+
+    def write_folded(self, path):
+        with open(path, 'w') as foldedfile:
+            for stack, count in sorted(self.counts.iteritems()):
+                foldedfile.write("%s %d\n" % (stack, count))
+
+
+class SchedulerProfiler(object):
+    """
+    Call counts, cumulative and percentile times per event type and handler of a scheduler
+    sample_interval - seconds between stack samples of the dispatching thread, None for no sampling
+    histograms - (event type, handler): latency.Histogram of the call durations, handler dispatch is the
+                 whole dispatch of the event including the handlers it calls
+    """
+
+    def __init__(self, sample_interval=None):
+        self.histograms = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.patched = []
+        self.sampler = None if sample_interval is None else StackSampler(sample_interval)
+
+    def record(self, handler, seconds):
+        key = (getattr(self.local, 'type', None), handler)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(seconds)
+
+    def timed(self, method, handler):
+        def timed_method(*args, **kwargs):
+            start = monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(handler, monotonic() - start)
+
+        return timed_method
+
+    def timed_dispatch(self, dispatch):
+        def timed_dispatch(event):
+            if self.sampler is not None and self.sampler.thread_id is None:
+                self.sampler.start(thread.get_ident())
+            previous = getattr(self.local, 'type', None)
+            self.local.type = event.type
+            start = monotonic()
+            try:
+                return dispatch(event)
+            finally:
+                self.record('dispatch', monotonic() - start)
+                self.local.type = previous
+
+        return timed_dispatch
+
+    def _patch(self, target, name, method):
+        self.patched.append((target, name, target.__dict__.get(name)))
+        setattr(target, name, method)
+
+    def attach(self, scheduler):
+        """
+        wraps the dispatch of scheduler and the handlers of its components
+        """
+        for owner, name in HANDLERS:
+            target = scheduler if owner is None else getattr(scheduler, owner, None)
+            if target is None or not hasattr(target, name):
+                continue
+            handler = name if owner is None else owner + "." + name
+            self._patch(target, name, self.timed(getattr(target, name), handler))
+        self._patch(scheduler, 'dispatch', self.timed_dispatch(scheduler.dispatch))
+
+    def detach(self):
+        """
+        restores the plain methods and stops the stack sampling
+        """
+        for target, name, original in reversed(self.patched):
+            if original is None:
+                delattr(target, name)
+            else:
+                setattr(target, name, original)
+        self.patched = []
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def report(self):
+        """
+        dict (event type, handler): count, total, mean, percentiles and max in seconds
+        """
+        report = {}
+        for key, histogram in self.histograms.items():
+            report[key] = histogram.summary()
+            report[key]['total'] = histogram.total
+        return report
+
+    def table(self):
+        """
+        report as text table, the most expensive handlers first
+        """
+        lines = ["%-8s %-34s %9s %10s %10s %10s %10s" % ('type', 'handler', 'calls', 'total s', 'mean us',
+                                                          'p50 us', 'p99 us')]
+        for (type, handler), row in sorted(self.report().iteritems(), key=lambda item: -item[1]['total']):
+            lines.append("%-8s %-34s %9d %10.3f %10.1f %10.1f %10.1f" % (type, handler, row['count'], row['total'],
+                                                                        row['mean'] * 1e6, row['p50'] * 1e6,
+                                                                        row['p99'] * 1e6))
+        return "\n".join(lines)
+
+    def write_folded(self, path):
+        """
+        writes the sampled stacks in folded format, requires sample_interval
+        """
+        if self.sampler is None:
+            raise ValueError("profiler was created without sample_interval")
+        self.sampler.write_folded(path)
@@ -0,0 +1,143 @@
+__author__ = 'jph'
+
+"""
+sessions.py provides the exchange session calendar for the live heartbeat
+
+SessionCalendar - NYSE regular sessions with holidays and early closes (13:00)
+
+Every session has precomputed boundaries in seconds since the epoch:
+OPEN - one minute after the open (portfolio update)
+BAR - every bar from two minutes after the open until two minutes before the close
+CLOSE - one minute before the close (close all positions)
+"""
+
+import bisect
+import calendar
+import datetime as dt
+
+import pytz
+
+# closures outside the holiday rules
+SPECIAL_CLOSURES = frozenset([dt.date(2001, 9, 11), dt.date(2001, 9, 12), dt.date(2001, 9, 13),
+                              dt.date(2001, 9, 14), dt.date(2004, 6, 11), dt.date(2007, 1, 2),
+                              dt.date(2012, 10, 29), dt.date(2012, 10, 30), dt.date(2018, 12, 5),
+                              dt.date(2025, 1, 9)])
+
+
+def easter(year):
+    """
+    easter sunday (gregorian calendar)
+    """
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return dt.date(year, month, day + 1)
+
+
+def nth_weekday(year, month, weekday, n):
+    """
+    n-th weekday (0 monday) of a month, n=-1 for the last one
+    """
+    if n > 0:
+        first = dt.date(year, month, 1)
+        return first + dt.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = dt.date(year + month // 12, month % 12 + 1, 1) - dt.timedelta(days=1)
+    return last - dt.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def observed(day):
+    """
+    holiday on a saturday is observed on friday, on a sunday on monday
+    """
+    if day.weekday() == 5:
+        return day - dt.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + dt.timedelta(days=1)
+    return day
+
+
+class SessionCalendar(object):
+    """
+    Regular sessions of an exchange, NYSE rules by default
+    bar - bar size in seconds
+    """
+
+    def __init__(self, tz='US/Eastern', open=dt.time(9, 30), close=dt.time(16, 0), early_close=dt.time(13, 0),
+                 bar=60, closures=SPECIAL_CLOSURES):
+        self.tz = pytz.timezone(tz)
+        self.open = open
+        self.close = close
+        self.early_close = early_close
+        self.bar = bar
+        self.closures = closures
+        self.years = {}
+        self.sessions = {}
+
+    def holidays(self, year):
+        """
+        set of holidays and early closes of a year (cached)
+        """
+        if year not in self.years:
+            thanksgiving = nth_weekday(year, 11, 3, 4)
+            holidays = set([nth_weekday(year, 1, 0, 3), nth_weekday(year, 2, 0, 3), easter(year) - dt.timedelta(days=2),
+                            nth_weekday(year, 5, 0, -1), observed(dt.date(year, 7, 4)), nth_weekday(year, 9, 0, 1),
+                            thanksgiving, observed(dt.date(year, 12, 25))])
+            new_year = dt.date(year, 1, 1)
+            if new_year.weekday() != 5:
+                holidays.add(observed(new_year))
+            if year >= 2022:
+                holidays.add(observed(dt.date(year, 6, 19)))
+            early_closes = set([thanksgiving + dt.timedelta(days=1)])
+            for day in (dt.date(year, 7, 3), dt.date(year, 12, 24)):
+                if day.weekday() < 4:
+                    early_closes.add(day)
+            self.years[year] = (holidays, early_closes)
+        return self.years[year]
+
+    def is_session(self, day):
+        return day.weekday() < 5 and day not in self.closures and day not in self.holidays(day.year)[0]
+
+    def session(self, day):
+        """
+        (open, close) of the session on day as seconds since the epoch, None if the exchange is closed
+        """
+        if not self.is_session(day):
+            return None
+        close = self.early_close if day in self.holidays(day.year)[1] else self.close
+        return self.seconds(day, self.open), self.seconds(day, close)
+
+    def seconds(self, day, time):
+        return calendar.timegm(self.tz.localize(dt.datetime.combine(day, time)).utctimetuple())
+
+    def boundaries(self, day):
+        """
+        sorted list of (seconds, kind) of the session on day, empty if the exchange is closed
+        """
+        if day not in self.sessions:
+            session = self.session(day)
+            if session is None:
+                self.sessions[day] = []
+            else:
+                open, close = session
+                bars = [(seconds, 'BAR') for seconds in xrange(open + 2 * self.bar, close - self.bar, self.bar)]
+                self.sessions[day] = [(open + self.bar, 'OPEN')] + bars + [(close - self.bar, 'CLOSE')]
+        return self.sessions[day]
+
+    def upcoming(self, seconds):
+        """
+        generator over (seconds, kind) of all boundaries from seconds on
+        """
+        day = dt.datetime.fromtimestamp(seconds, self.tz).date()
+        while True:
+            boundaries = self.boundaries(day)
+            for boundary in boundaries[bisect.bisect_left(boundaries, (seconds,)):]:
+                yield boundary
+            self.sessions.pop(day, None)
+            day += dt.timedelta(days=1)
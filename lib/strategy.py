@@ -10,6 +10,13 @@ class Strategy(object):
         self.queue = queue
         self.datahandler = datahandler
 
+    def register_indicator(self, name, indicator, symbol=None):
+        """
+        Registers an incremental indicator at the datahandler, read its value in calculate_signals
+        e.g. self.sma = self.register_indicator('sma20', RollingMean(20))
+        """
+        return self.datahandler.register_indicator(name, indicator, symbol)
+
 
     def calculate_signals(self):
         """
@@ -0,0 +1,118 @@
+__author__ = 'jph'
+
+"""
+sweep.py runs a strategy over a parameter grid on a process pool
+
+Every run is a SynchronousBacktestScheduler backtest on its own DirectQueue. The bar data is converted to a
+BarStore once, so the workers memory-map the same read-only files instead of unpickling the data each.
+Results are compact metrics dicts, collected as the runs finish.
+
+command line:
+python -m lib.sweep mymodule:MyStrategy --grid '{"window": [10, 20, 50]}' --workfile workfile_tmp.p --split 0.1
+"""
+
+import os
+import sys
+import json
+import argparse
+import itertools
+import importlib
+import traceback
+import multiprocessing
+
+import pandas as pd
+
+from lib.util import DirectQueue
+from lib.barstore import pickle_to_barstore
+from lib.datahandler import BacktestDataHandler
+from lib.portfolio import SimPortfolio
+from lib.trading import FakeBacktestTradingHandler
+from lib.eventscheduler import SynchronousBacktestScheduler
+
+
+def parameter_grid(grid):
+    """
+    all combinations of a dict parameter: list of values as list of dicts
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def shared_workfile(workfile):
+    """
+    BarStore directory for workfile, a pickle is converted once next to it (<workfile>.bars)
+    """
+    if os.path.isdir(workfile):
+        return workfile
+    path = os.path.splitext(workfile)[0] + '.bars'
+    if not os.path.isdir(path) or os.path.getmtime(path) < os.path.getmtime(workfile):
+        pickle_to_barstore(workfile, path)
+    return path
+
+
+def run_backtest(strategy_class, params, workfile, split=0.1, capital=1000000.0, max_leverage=1, **datakwargs):
+    """
+    single synchronous backtest, returns its BacktestResult
+    datakwargs - passed to BacktestDataHandler (start, end, test_bars, indicators)
+    """
+    queue = DirectQueue()
+    datahandler = BacktestDataHandler(queue, workfile, split=split, **datakwargs)
+    portfolio = SimPortfolio(queue, capital=capital, max_leverage=max_leverage)
+    trader = FakeBacktestTradingHandler(queue)
+    strategy = strategy_class(queue, datahandler, **params)
+    return SynchronousBacktestScheduler(queue, datahandler, strategy, portfolio, trader, verbose=False).run()
+
+
+def _run(job):
+    strategy_class, params, workfile, split, kwargs = job
+    try:
+        metrics = run_backtest(strategy_class, params, workfile, split, **kwargs).metrics()
+    except Exception:
+        metrics = {'error': traceback.format_exc()}
+    metrics['params'] = params
+    return metrics
+
+
+def sweep(strategy_class, grid, workfile, split=0.1, processes=None, **kwargs):
+    """
+    Generator over the metrics of all runs of strategy_class(queue, datahandler, **params) for params in grid,
+    in order of completion
+    processes - pool size, default all cores
+    kwargs - passed to run_backtest (capital, max_leverage)
+    """
+    workfile = shared_workfile(workfile)
+    jobs = [(strategy_class, params, workfile, split, kwargs) for params in parameter_grid(grid)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for metrics in pool.imap_unordered(_run, jobs):
+            yield metrics
+    finally:
+        pool.terminate()
+
+
+def load_class(name):
+    """
+    class from 'package.module:Class'
+    """
+    module, classname = name.split(':')
+    return getattr(importlib.import_module(module), classname)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Parallel parameter sweep')
+    parser.add_argument('strategy', help='strategy class as package.module:Class')
+    parser.add_argument('--grid', required=True, help='json dict parameter: list of values')
+    parser.add_argument('--workfile', default='workfile_tmp.p')
+    parser.add_argument('--split', type=float, default=0.1)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--output', default=None, help='csv file for all results')
+    args = parser.parse_args()
+
+    results = []
+    for metrics in sweep(load_class(args.strategy), json.loads(args.grid), args.workfile, args.split,
+                         args.processes):
+        print json.dumps(metrics, default=str)
+        sys.stdout.flush()
+        results.append(metrics)
+    if args.output is not None:
+        pd.DataFrame(results).to_csv(args.output)
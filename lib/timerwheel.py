@@ -0,0 +1,166 @@
+__author__ = 'jph'
+
+"""
+timerwheel.py provides delayed callbacks without a thread per timer
+
+TimerWheel - hierarchical timing wheel, driven by calling advance(now)
+             in backtests it is advanced with the bar time, so timed events are deterministic
+TimerService - TimerWheel driven by a single background thread on wall-clock time
+
+Level l of the wheel has slots buckets of resolution * slots**l seconds. A timer is placed on the lowest level
+whose current period contains its expiry and is cascaded to lower levels when that bucket comes up.
+Timers beyond the top level wait in an overflow list. Cancelling only marks the timer.
+"""
+
+import math
+import time
+import threading
+
+
+class Timer(object):
+    """
+    Handle of a scheduled callback
+    """
+    __slots__ = ('expires', 'callback', 'args', 'cancelled')
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timing wheel
+    resolution - seconds per tick
+    """
+
+    def __init__(self, resolution=1.0, slots=64, levels=4):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.lock = threading.RLock()
+        self.current = None
+        self.cancel_all()
+
+    def cancel_all(self):
+        with self.lock:
+            self.wheels = [[[] for slot in xrange(self.slots)] for level in xrange(self.levels)]
+            self.level_counts = [0] * self.levels
+            self.overflow = []
+            self.due = []
+            self.count = 0
+
+    def now(self):
+        """
+        time of the last advance
+        """
+        return None if self.current is None else self.current * self.resolution
+
+    def schedule(self, delay, callback, *args):
+        """
+        calls callback(*args) delay seconds after the last advance, returns a Timer that can be cancelled
+        """
+        with self.lock:
+            if self.current is None:
+                self.current = int(time.time() // self.resolution)
+            timer = Timer(self.current + int(math.ceil(delay / self.resolution)), callback, args)
+            if timer.expires <= self.current:
+                self.due.append(timer)
+            else:
+                self._place(timer)
+            return timer
+
+    def _place(self, timer):
+        period = 1
+        for level in xrange(self.levels):
+            span = period * self.slots
+            if timer.expires // span == self.current // span:
+                self.wheels[level][(timer.expires // period) % self.slots].append(timer)
+                self.level_counts[level] += 1
+                self.count += 1
+                return
+            period = span
+        self.overflow.append(timer)
+        self.count += 1
+
+    def _cascade(self):
+        if self.current % self.slots ** self.levels == 0:
+            overflow, self.overflow = self.overflow, []
+            self.count -= len(overflow)
+            for timer in overflow:
+                self._place(timer)
+        for level in xrange(self.levels - 1, 0, -1):
+            period = self.slots ** level
+            if self.current % period == 0:
+                slot = (self.current // period) % self.slots
+                bucket, self.wheels[level][slot] = self.wheels[level][slot], []
+                self.level_counts[level] -= len(bucket)
+                self.count -= len(bucket)
+                for timer in bucket:
+                    self._place(timer)
+
+    def _expire(self):
+        slot = self.current % self.slots
+        bucket, self.wheels[0][slot] = self.wheels[0][slot], []
+        self.level_counts[0] -= len(bucket)
+        self.count -= len(bucket)
+        return bucket
+
+    def advance(self, now):
+        """
+        moves the wheel to time now (seconds) and runs all expired callbacks in expiry order
+        empty stretches are skipped up to the next bucket that holds timers
+        """
+        target = int(now // self.resolution)
+        with self.lock:
+            if self.current is None:
+                self.current = target
+            expired, self.due = self.due, []
+            while self.current < target:
+                if self.count == 0:
+                    self.current = target
+                    break
+                level = 0
+                while level < self.levels and self.level_counts[level] == 0:
+                    level += 1
+                period = self.slots ** level
+                boundary = (self.current // period + 1) * period
+                if boundary > target:
+                    self.current = target
+                    break
+                self.current = boundary
+                self._cascade()
+                expired.extend(self._expire())
+        fired = 0
+        for timer in expired:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+                fired += 1
+        return fired
+
+
+class TimerService(TimerWheel):
+    """
+    TimerWheel advanced on wall-clock time by one daemon thread
+    """
+
+    def __init__(self, resolution=1.0, slots=64, levels=4):
+        super(TimerService, self).__init__(resolution, slots, levels)
+        self.thread = None
+
+    def start(self):
+        def run():
+            while True:
+                now = time.time()
+                self.advance(now)
+                time.sleep(self.resolution - now % self.resolution)
+
+        self.thread = threading.Thread(target=run, name="timer_service")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
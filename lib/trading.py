@@ -4,11 +4,14 @@ import datetime as dt
 import random
 import threading
 import time
-from Queue import Queue
+from Queue import Queue, Empty
 
 import pytz
 
 from lib.events import FillEvent, ErrorEvent, StartStopEvent
+from lib.orderbook import OrderBook, fill_price
+from lib.clock import LiveClock
+from lib import latency
 
 
 class TradingHandler(object):
@@ -49,74 +52,90 @@ class FakeInstantTradingHandler(TradingHandler):
 class FakeBacktestTradingHandler(TradingHandler):
     """
     simulates fills in a backtesting environment
+    an order is checked against the execution bar (datahandler.get_execution_data) of its symbol, see
+    orderbook.fill_price, limit and stop orders that do not fill there rest in an orderbook.OrderBook per
+    symbol and are matched against every following execution bar until they fill or time_valid minutes of
+    execution bar time (datahandler.get_execution_time) have passed or cancel_orders removes them (the scheduler
+    does on CLOSE signals and schedule cancels)
+    resting=False (default) drops them after the first bar, the fills of vectorized.py (see vectorized.event_parity)
     """
 
-    def __init__(self, queue):
+    def __init__(self, queue, resting=False):
         super(FakeBacktestTradingHandler, self).__init__(queue)
         self.fakeid = 37
-        self.lastprice = None
+        self.resting = resting
+        self.datahandler = None
+        self.bars = {}
+        self.books = {}
 
     def update_prices(self, datahandler):
-        self.lastprice = datahandler.get_execution_data()
+        self.datahandler = datahandler
+        self.bars = {}
+        for symbol, book in self.books.iteritems():
+            if book:
+                stamp, bar = self.execution_bar(symbol)
+                if bar is None:
+                    continue
+                for order, price in book.match(stamp, bar):
+                    self.fill(order, price)
+
+    def execution_bar(self, symbol):
+        """
+        (execution time, execution bar) of symbol for the current market event, bar None if symbol has no bars left
+        """
+        if symbol not in self.bars:
+            self.bars[symbol] = (self.datahandler.get_execution_time(symbol),
+                                 self.datahandler.get_execution_data(symbol))
+        return self.bars[symbol]
+
+    def fill(self, order, price):
+        fill_event = FillEvent(order.symbol, 'BATS', order.quantity, order.side, order.quantity * 0.01, self.fakeid,
+                               price, ordereventid=order.id, signalid=order.signalid)
+        self.fakeid += 1
+        self.queue.put(fill_event)
 
-    def execute_order(self, event):
-        if event.order_type == "MKT":
-            if event.trigger is None:
-                #MKT Order without Trigger
-                price = self.lastprice['open']
-                fill_event = FillEvent(event.symbol,
-                                       'BATS', event.quantity, event.side, event.quantity * 0.01, self.fakeid, price,
-                                       ordereventid=event.id, signalid=event.signalid)
-                self.fakeid += 1
-                self.queue.put(fill_event)
+    def cancel_order(self, ordereventid):
+        """
+        cancels the resting order of the OrderEvent id, returns the order or None
+        """
+        for book in self.books.itervalues():
+            order = book.cancel(ordereventid)
+            if order is not None:
+                return order
+        return None
+
+    def cancel_orders(self, signalid=None, symbol=None):
+        """
+        cancels the resting orders of signal signalid and/or symbol, all with neither, returns the cancelled orders
+        """
+        cancelled = []
+        for book_symbol, book in self.books.iteritems():
+            if symbol is not None and book_symbol != symbol:
+                continue
+            if signalid is None:
+                cancelled.extend(book.orders.itervalues())
+                book.cancel_all()
             else:
-                #Trigger set
-                if event.side == "BUY":
-                    if event.trigger < self.lastprice['high']:
-                        if event.trigger < self.lastprice['open']:
-                            price = self.lastprice['open']
-                        else:
-                            price = event.trigger
-                        fill_event = FillEvent(event.symbol,
-                                               'BATS', event.quantity, event.side, event.quantity * 0.01, self.fakeid,
-                                               price, ordereventid=event.id, signalid=event.signalid)
-                        self.fakeid += 1
-                        self.queue.put(fill_event)
-                if event.side == "SELL":
-                    if event.trigger > self.lastprice['low']:
-                        if event.trigger > self.lastprice['open']:
-                            price = self.lastprice['open']
-                        else:
-                            price = event.trigger
-                        fill_event = FillEvent(event.symbol,
-                                               'BATS', event.quantity, event.side, event.quantity * 0.01, self.fakeid,
-                                               price, ordereventid=event.id, signalid=event.signalid)
-                        self.fakeid += 1
-                        self.queue.put(fill_event)
+                cancelled.extend(book.cancel_signal(signalid))
+        return cancelled
+
+    def resting_signals(self):
+        """
+        signal ids of the resting orders
+        """
+        return set(order.signalid for book in self.books.itervalues() for order in book.orders.itervalues())
 
-        elif event.order_type == "LMT":
-            if event.side == "BUY":
-                if event.limit > self.lastprice['low']:
-                    if event.limit > self.lastprice['open']:
-                        price = self.lastprice['open']
-                    else:
-                        price = event.limit
-                    fill_event = FillEvent(event.symbol,
-                                           'BATS', event.quantity, event.side, event.quantity * 0.01, self.fakeid,
-                                           price, ordereventid=event.id, signalid=event.signalid)
-                    self.fakeid += 1
-                    self.queue.put(fill_event)
-            elif event.side == "SELL":
-                if event.limit < self.lastprice['high']:
-                    if event.limit < self.lastprice['open']:
-                        price = self.lastprice['open']
-                    else:
-                        price = event.limit
-                    fill_event = FillEvent(event.symbol,
-                                           'BATS', event.quantity, event.side, event.quantity * 0.01, self.fakeid,
-                                           price, ordereventid=event.id, signalid=event.signalid)
-                    self.fakeid += 1
-                    self.queue.put(fill_event)
+    def execute_order(self, event):
+        stamp, bar = self.execution_bar(event.symbol)
+        if bar is None:
+            return
+        price = fill_price(event, bar)
+        if price is not None:
+            self.fill(event, price)
+        elif self.resting:
+            if event.symbol not in self.books:
+                self.books[event.symbol] = OrderBook()
+            self.books[event.symbol].add(event, stamp)
 
 
 class IBTradingHandler(TradingHandler):
@@ -124,12 +143,18 @@ class IBTradingHandler(TradingHandler):
     simulates fills in a backtesting environment
     """
 
-    def __init__(self, queue, ibcon):
+    def __init__(self, queue, ibcon, clock=None, threaded=True):
+        """
+        clock - time source for the order expiry, default the wall clock, a scheduler replaces it by its own
+        threaded - poll the fills on an own thread, False if poll_fills runs as a task of an EventLoop
+        """
         super(IBTradingHandler, self).__init__(queue)
+        self.clock = LiveClock() if clock is None else clock
         self.ibcon = ibcon
         self.lastprice = None
         self.open_orders = Queue()
-        self.get_fills()
+        if threaded:
+            self.get_fills()
 
     def update_prices(self):
         self.lastprice = self.ibcon.getspy()['last']
@@ -152,38 +177,55 @@ class IBTradingHandler(TradingHandler):
 
         tif = "GTD"
         time_valid = dt.timedelta(minutes=event.time_valid) - dt.timedelta(seconds=1)
-        goodtill = self.cet.localize(dt.datetime.today() + time_valid)
+        goodtill = self.clock.localize(self.clock.now() + time_valid)
 
         self.open_orders.put({'orderid': self.ibcon.nextID, 'ordereventid': event.id, 'signalid': event.signalid})
+        if latency.tracer is not None:
+            latency.tracer.stage('bar_to_place_order')
         self.ibcon.place_order(side, symbol, size, ordertype, stpprice=stpprice, lmtprice=lmtprice, rth=1, tif=tif,
                                goodtill=goodtill, orderref=str(event.id))
 
+    def poll_fills(self, interval=0.1):
+        """
+        generator over the seconds to wait between order status checks
+        puts a FillEvent for every open order that is filled
+        """
+        while True:
+            try:
+                orderdict = self.open_orders.get_nowait()
+            except Empty:
+                yield interval
+                continue
+            order = orderdict['orderid']
+            if order in self.ibcon.orders:
+                if 'status' in self.ibcon.orders[order]:
+                    if self.ibcon.orders[order]['status'] == "Filled":
+                        ordercost = round((self.ibcon.orders[order]['filled'] * 0.005) + \
+                                          (self.ibcon.orders[order]['filled'] * self.ibcon.orders[order][
+                                              'avgfillprice'] * 0.0000221 * (
+                                           self.ibcon.orders[order]['side'] == "SELL")), 2)
+
+                        fill_event = FillEvent(self.ibcon.orders[order]['symbol'], 'SMART',
+                                               self.ibcon.orders[order]['filled'],
+                                               self.ibcon.orders[order]['side'],
+                                               ordercost, order,
+                                               self.ibcon.orders[order]['avgfillprice'],
+                                               ordereventid=orderdict['ordereventid'],
+                                               permid=self.ibcon.orders[order]['permid'],
+                                               signalid=orderdict['signalid'])
+                        if latency.tracer is not None:
+                            latency.tracer.caused(fill_event, self.ibcon.orders[order].get('filledtime'),
+                                                  'status_to_fill_event')
+                        self.queue.put(fill_event)
+                        continue
+            self.open_orders.put(orderdict)
+            yield interval
+
     def get_fills(self):
         def check_orders():
             try: #TODO raus debug
-                while True:
-                    orderdict = self.open_orders.get()
-                    order = orderdict['orderid']
-                    if order in self.ibcon.orders:
-                        if 'status' in self.ibcon.orders[order]:
-                            if self.ibcon.orders[order]['status'] == "Filled":
-                                ordercost = round((self.ibcon.orders[order]['filled'] * 0.005) + \
-                                                  (self.ibcon.orders[order]['filled'] * self.ibcon.orders[order][
-                                                      'avgfillprice'] * 0.0000221 * (
-                                                   self.ibcon.orders[order]['side'] == "SELL")), 2)
-
-                                fill_event = FillEvent(self.ibcon.orders[order]['symbol'], 'SMART',
-                                                       self.ibcon.orders[order]['filled'],
-                                                       self.ibcon.orders[order]['side'],
-                                                       ordercost, order,
-                                                       self.ibcon.orders[order]['avgfillprice'],
-                                                       ordereventid=orderdict['ordereventid'],
-                                                       permid=self.ibcon.orders[order]['permid'],
-                                                       signalid=orderdict['signalid'])
-                                self.queue.put(fill_event)
-                                continue
-                    self.open_orders.put(orderdict)
-                    time.sleep(0.1)
+                for wait in self.poll_fills():
+                    time.sleep(wait)
             except:
                 import sys
 
@@ -1,11 +1,18 @@
 __author__ = 'jph'
 
-from Queue import Queue
+from Queue import Queue, Empty
+from collections import deque
+import sys
 import threading
 import datetime as dt
 import time
 import functools
 
+from journal import EventJournal
+from logwriter import LogWriter
+from pausebuffer import PauseBuffer
+import latency
+
 
 def synch(returnloc, timeout=5, required=()):
     """
@@ -37,71 +44,168 @@ def synch(returnloc, timeout=5, required=()):
     return decorate
 
 
+class DirectQueue(deque):
+    """
+    Lock free replacement for Queue in single threaded runs
+    put appends and get pops without blocking, get on an empty queue raises IndexError
+    """
+    put = deque.append
+    get = deque.popleft
+
+    def empty(self):
+        return not self
+
+    def qsize(self):
+        return len(self)
+
+
+def prefetch(iterable, depth=1):
+    """
+    Generator that consumes iterable on a background thread and keeps up to depth items ready
+    exceptions of the background thread are raised in the consumer
+    """
+    buffer = Queue(maxsize=depth)
+    end = object()
+
+    def fill():
+        try:
+            for item in iterable:
+                buffer.put((item, None))
+        except Exception:
+            buffer.put((None, sys.exc_info()))
+        buffer.put((end, None))
+
+    t = threading.Thread(target=fill, name="prefetch")
+    t.daemon = True
+    t.start()
+    while True:
+        item, error = buffer.get()
+        if error is not None:
+            raise error[0], error[1], error[2]
+        if item is end:
+            return
+        yield item
+
+
 class QueuePreprocessor(object):
     """
     Adds logging and start/stop functionality to Queue
     """
 
-    def __init__(self, input_queue, enable_logging=True, logfile="log.txt", mode="quiet"):
+    def __init__(self, input_queue, enable_logging=True, logfile="log.txt", mode="quiet", journal=None,
+                 output_queue=None, writer=None, pause_buffer=None, replay_rate=None):
         """
         Parameters:
         input_queue
         logfile
         mode - (verbose/quiet)
+        journal - path of an additional binary event journal (see journal.py)
+        output_queue - queue of the scheduler, e.g. an eventbus.PriorityEventQueue, default a FIFO Queue
+        writer - logwriter.LogWriter for batching/rotation settings, default LogWriter(logfile)
+        pause_buffer - pausebuffer.PauseBuffer for the events arriving while stopped, default PauseBuffer()
+        replay_rate - maximum events per second passed on when resuming, None for no limit
+                      the replay runs on the preprocessing thread, events arriving meanwhile are only logged
+                      and passed on after it, so they stay behind the replayed ones
         """
         self.input_queue = input_queue
         self.logfile = logfile
+        self.journal = None if journal is None else EventJournal(journal)
         self.logging_queue = Queue()
+        self.max_logging_queue = 0
         self.enable_logging = enable_logging
+        if enable_logging:
+            self.writer = LogWriter(logfile) if writer is None else writer
+        else:
+            self.writer = None
         self.mode = mode
-        self.output_queue = Queue()
+        self.output_queue = Queue() if output_queue is None else output_queue
         self.stopped = False
+        self.pause_buffer = PauseBuffer() if pause_buffer is None else pause_buffer
+        self.replay_rate = replay_rate
         self.t = threading.Thread(target=self.preprocessing, name="preprocessing_queue",
                                   args=(self.input_queue, self.output_queue, self.logging_queue))
         self.t.daemon = True
         self.t.start()
         self.t2 = threading.Thread(target=self.logging, name="logging_queue",
-                                   args=(self.logging_queue, self.logfile, self.mode, self.logging))
+                                   args=(self.logging_queue, self.writer, self.mode))
         self.t2.daemon = True
         self.t2.start()
 
     def preprocessing(self, input_queue, output_queue, logging_queue):
         """"
         Takes input queue and output queue, logs every item and stop for start/stop items
+        events arriving while stopped are logged at once and kept in the pause buffer, the next STOP
+        passes the retained ones on (rate limited)
         """
         while True:
             element = input_queue.get()
             if element.type == "STOP":
                 logging_queue.put(element)
                 self.stopped = True
-                zwisafe = []
                 while self.stopped:
                     element2 = input_queue.get()
+                    logging_queue.put(element2)
                     if element2.type == "STOP":
-                        logging_queue.put(element2)
-                        for zwielement in zwisafe:
-                            logging_queue.put(zwielement)
+                        for zwielement in self.pause_buffer.replay(self.replay_rate):
+                            if latency.tracer is not None:
+                                latency.tracer.enqueued(zwielement)
                             output_queue.put(zwielement)
                         self.stopped = False
                     else:
-                        zwisafe.append(element2)
-                        #time.sleep(0.001)
+                        self.pause_buffer.add(element2)
             else:
                 logging_queue.put(element)
+                if latency.tracer is not None:
+                    latency.tracer.enqueued(element)
                 output_queue.put(element)
                 #time.sleep(0.001)
 
-    def logging(self, input_queue, logfile, mode, logging):
+    def logging(self, input_queue, writer, mode):
         """
-        logs and/or outputs all events
+        logs and/or outputs all events, the log is flushed in batches (see LogWriter), when no event arrived
+        for flush_interval seconds and on STOP
+        None closes the log (see close)
         """
+        interval = 1.0 if writer is None else writer.flush_interval
         while True:
-            element = input_queue.get()
-            now = dt.datetime.today()
+            try:
+                element = input_queue.get(timeout=interval)
+            except Empty:
+                if writer is not None:
+                    writer.flush_if_due()
+                if self.journal is not None:
+                    self.journal.flush()
+                continue
+            self.max_logging_queue = max(self.max_logging_queue, input_queue.qsize() + 1)
+            if element is None:
+                break
             if mode == "verbose":
                 print element.timestamp
                 print element.type
-            if logging:
-                with open(logfile, 'a') as x:
-                    x.write(now.strftime('%m/%d-%H:%M:%S') + "," + element.type + "," + str(element) + "\n")
-                    #time.sleep(0.001)
+            if writer is not None:
+                writer.write(element)
+            if self.journal is not None:
+                self.journal.write(element)
+            if element.type == "STOP":
+                if writer is not None:
+                    writer.flush()
+                if self.journal is not None:
+                    self.journal.flush()
+        if writer is not None:
+            writer.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    def close(self, timeout=None):
+        """
+        writes all queued events to the log and closes it
+        """
+        self.logging_queue.put(None)
+        self.t2.join(timeout)
+
+    def stats(self):
+        """
+        logging queue depth (current and maximum) and the write throughput of the log
+        """
+        return {'logging_queue': self.logging_queue.qsize(), 'max_logging_queue': self.max_logging_queue,
+                'writer': None if self.writer is None else self.writer.throughput()}
@@ -0,0 +1,190 @@
+__author__ = 'jph'
+
+"""
+vectorized.py provides a vectorized backtest for per-bar signal strategies
+
+Fills follow FakeBacktestTradingHandler(resting=False) (orderbook.fill_price): a signal after bar t is checked
+against bar t+1 only
+MKT - fills at the open
+MKT with trigger (stop) - BUY if trigger < high, SELL if trigger > low, at the open if it is already through
+LMT - BUY if limit > low, SELL if limit < high, at the open if it is already through
+commission is 0.01 per share
+
+Exits follow Portfolio.close_signal: duration minutes after the signal bar an opposite signal with the same
+trigger is sent, whether the entry filled or not (gate_exit=True closes filled entries only).
+Portfolio sizing and max leverage checks are not simulated, quantity is given per signal.
+
+event_parity - regression check, runs limit order signals through the event engine and vectorized_backtest
+"""
+
+import numpy as np
+import pandas as pd
+
+from lib.eventscheduler import equity_metrics
+
+NS_PER_MINUTE = 60 * 10 ** 9
+
+
+def _per_signal(value, n):
+    """
+    scalar, None or array as float array of length n, None becomes NaN
+    """
+    if value is None:
+        return np.full(n, np.nan)
+    return np.broadcast_to(np.asarray(value, dtype=float), (n,))
+
+
+def fill_prices(side, open, high, low, limit, trigger):
+    """
+    fill flag and price for orders checked against one bar each, all arguments are arrays
+    side +1 BUY / -1 SELL, NaN limit means market order, NaN trigger means no trigger
+    """
+    buy = side > 0
+    is_limit = ~np.isnan(limit)
+    is_stop = ~is_limit & ~np.isnan(trigger)
+    with np.errstate(invalid='ignore'):
+        limit_filled = np.where(buy, limit > low, limit < high)
+        limit_through = np.where(buy, limit > open, limit < open)
+        stop_filled = np.where(buy, trigger < high, trigger > low)
+        stop_through = np.where(buy, trigger < open, trigger > open)
+    filled = np.where(is_limit, limit_filled, np.where(is_stop, stop_filled, True))
+    price = np.where(is_limit, np.where(limit_through, open, limit),
+                     np.where(is_stop, np.where(stop_through, open, trigger), open))
+    return filled, price
+
+
+class VectorizedResult(object):
+    """
+    Outcome of vectorized_backtest
+    fills - DataFrame with one row per fill
+    position, equity - per bar Series
+    """
+
+    def __init__(self, fills, position, equity):
+        self.fills = fills
+        self.position = position
+        self.equity = equity
+
+    def metrics(self):
+        metrics = equity_metrics(self.equity)
+        metrics['fills'] = len(self.fills)
+        metrics['bars'] = len(self.equity)
+        return metrics
+
+
+def vectorized_backtest(data, signals, quantity=100, limit=None, trigger=None, duration=None, capital=1000000.0,
+                        commission=0.01, gate_exit=False):
+    """
+    Parameters:
+    data - bar DataFrame with open, high, low, close and a DatetimeIndex
+    signals - per bar +1 (BUY), -1 (SELL) or 0, evaluated after the bar closed
+    quantity, limit, trigger, duration - scalar or per bar, None for no limit/trigger/exit
+    duration - minutes until the opposite exit signal, like SignalEvent.duration
+    """
+    open, high, low, close = (np.asarray(data[field], dtype=float) for field in ('open', 'high', 'low', 'close'))
+    stamps = data.index.asi8
+    n = len(close)
+    signals = np.asarray(signals)
+    quantity = _per_signal(quantity, n)
+    limit = _per_signal(limit, n)
+    trigger = _per_signal(trigger, n)
+    duration = _per_signal(duration, n)
+
+    # entries: signal after bar t, order checked against bar t+1
+    signal_bars = np.flatnonzero(signals[:n - 1] != 0)
+    side = np.sign(signals[signal_bars]).astype(float)
+    bars = signal_bars + 1
+    filled, price = fill_prices(side, open[bars], high[bars], low[bars], limit[signal_bars], trigger[signal_bars])
+
+    # exits: opposite market order with the entry trigger, signal at the first bar duration minutes later
+    has_exit = ~np.isnan(duration[signal_bars])
+    if gate_exit:
+        has_exit &= filled
+    exit_from = signal_bars[has_exit]
+    exit_signal = np.searchsorted(stamps, stamps[exit_from] + (duration[exit_from] * NS_PER_MINUTE).astype(np.int64))
+    in_data = exit_signal + 1 < n
+    exit_from, exit_signal = exit_from[in_data], exit_signal[in_data]
+    exit_bars = exit_signal + 1
+    exit_side = -np.sign(signals[exit_from]).astype(float)
+    exit_filled, exit_price = fill_prices(exit_side, open[exit_bars], high[exit_bars], low[exit_bars],
+                                          np.full(len(exit_bars), np.nan), trigger[exit_from])
+
+    fills = pd.DataFrame({
+        'bar': np.concatenate((bars[filled], exit_bars[exit_filled])),
+        'side': np.concatenate((side[filled], exit_side[exit_filled])),
+        'quantity': np.concatenate((quantity[signal_bars][filled], quantity[exit_from][exit_filled])),
+        'price': np.concatenate((price[filled], exit_price[exit_filled])),
+        'kind': ['entry'] * int(filled.sum()) + ['exit'] * int(exit_filled.sum())},
+        columns=['bar', 'side', 'quantity', 'price', 'kind'])
+    fills = fills.sort_values('bar', kind='mergesort').reset_index(drop=True)
+    fills['quantity'] = np.floor(fills.quantity)
+    fills['commission'] = fills.quantity * commission
+    fills['timestamp'] = data.index[fills.bar.values]
+
+    signed = fills.side.values * fills.quantity.values
+    position_change = np.zeros(n)
+    cash_change = np.zeros(n)
+    np.add.at(position_change, fills.bar.values, signed)
+    np.add.at(cash_change, fills.bar.values, -signed * fills.price.values - fills.commission.values)
+    position = np.cumsum(position_change)
+    equity = capital + np.cumsum(cash_change) + position * close
+    return VectorizedResult(fills, pd.Series(position, index=data.index), pd.Series(equity, index=data.index))
+
+
+def event_parity(workfile='workfile_tmp.p', split=0.5, every=50, offset=0.05):
+    """
+    Regression check of the event engine fills against vectorized_backtest
+    every `every` bars a LMT signal offset below (BUY) or above (SELL) the close, alternating, runs through a
+    SynchronousBacktestScheduler with the default FakeBacktestTradingHandler and through vectorized_backtest
+    returns the (timestamp, price) fills of both, they are equal unless the fill rules diverge
+    """
+    from lib.util import DirectQueue
+    from lib.events import SignalEvent
+    from lib.strategy import Strategy
+    from lib.portfolio import SimPortfolio
+    from lib.timerwheel import TimerWheel
+    from lib.trading import FakeBacktestTradingHandler
+    from lib.datahandler import BacktestDataHandler
+    from lib.eventscheduler import SynchronousBacktestScheduler
+
+    class LimitStrategy(Strategy):
+        def __init__(self, queue, datahandler):
+            super(LimitStrategy, self).__init__(queue, datahandler)
+            self.signals = {}
+
+        def calculate_signals(self):
+            if len(self.signals) * every >= self.datahandler.cursor - start:
+                return
+            side = 1 if len(self.signals) % 2 == 0 else -1
+            close = self.datahandler.get_latest_bar()['close']
+            self.signals[self.datahandler.stamps[self.datahandler.cursor - 1]] = (side, close - side * offset)
+            self.queue.put(SignalEvent('BUY' if side > 0 else 'SELL', 0.5, limit=close - side * offset))
+
+    class RecordingPortfolio(SimPortfolio):
+        def get_fill(self, event):
+            self.fills.append((self.datahandler.stamps[self.datahandler.cursor], event.price))
+            return super(RecordingPortfolio, self).get_fill(event)
+
+    queue = DirectQueue()
+    datahandler = BacktestDataHandler(queue, workfile, split=split)
+    start = datahandler.cursor
+    strategy = LimitStrategy(queue, datahandler)
+    portfolio = RecordingPortfolio(queue, max_leverage=100, timers=TimerWheel())
+    portfolio.fills, portfolio.datahandler = [], datahandler
+    SynchronousBacktestScheduler(queue, datahandler, strategy, portfolio, FakeBacktestTradingHandler(queue)).run()
+
+    data = pd.DataFrame(dict((field, datahandler.columns[field]) for field in ('open', 'high', 'low', 'close')),
+                        index=pd.DatetimeIndex(datahandler.stamps))
+    signals = np.zeros(len(data))
+    limits = np.full(len(data), np.nan)
+    for stamp, (side, limit) in strategy.signals.iteritems():
+        bar = data.index.asi8.searchsorted(stamp)
+        signals[bar], limits[bar] = side, limit
+    fills = vectorized_backtest(data, signals, limit=limits).fills
+    return portfolio.fills, zip(fills.timestamp.values.view(np.int64), fills.price)
+
+
+if __name__ == "__main__":
+    event_fills, vectorized_fills = event_parity()
+    assert event_fills == vectorized_fills, "event engine and vectorized_backtest fills differ"
+    print "%d fills equal" % len(event_fills)
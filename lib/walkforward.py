@@ -0,0 +1,133 @@
+__author__ = 'jph'
+
+"""
+walkforward.py evaluates a strategy out-of-sample over consecutive folds
+
+The test region after the first train window is cut into folds. Each fold runs as a separate backtest
+on a process pool over the bar store, the train window in front of its test window is only used as history.
+rolling - every train window has the same length
+anchored - every train window starts at the first bar
+
+Indicators are not replayed over the prefix per fold: for anchored windows one sequential pass warms them up
+once and hands each fold a snapshot taken at its first test bar, rolling windows only warm up over their
+train bars. The out-of-sample equity curves are stitched into one curve by chaining the fold returns.
+"""
+
+import copy
+import traceback
+import multiprocessing
+
+import pandas as pd
+
+from lib.util import DirectQueue
+from lib.barstore import BarStore
+from lib.datahandler import BacktestDataHandler
+from lib.eventscheduler import equity_metrics
+from lib.sweep import shared_workfile, run_backtest
+
+
+def walk_forward_windows(length, folds, train, anchored=False):
+    """
+    list of (train start, test start, test end) rows
+    the bars after the first train bars are split into folds test windows of equal size
+    raises ValueError if not every fold gets at least one test bar
+    """
+    if folds < 1:
+        raise ValueError("folds must be at least 1, got %s" % folds)
+    if train < 0 or train >= length:
+        raise ValueError("train must be at least 0 and below the %d bars of the data, got %s" % (length, train))
+    if length - train < folds:
+        raise ValueError("%d test bars after %d train bars do not fill %d folds" % (length - train, train, folds))
+    bounds = [train + (length - train) * i // folds for i in xrange(folds + 1)]
+    return [(0 if anchored else max(test_start - train, 0), test_start, test_end)
+            for test_start, test_end in zip(bounds[:-1], bounds[1:]) if test_end > test_start]
+
+
+def indicator_snapshots(strategy_class, params, workfile, windows, length):
+    """
+    warms up the indicators of strategy_class once in bar order and copies them at every test start
+    """
+    datahandler = BacktestDataHandler(DirectQueue(), workfile, test_bars=length - windows[0][1])
+    strategy_class(datahandler.queue, datahandler, **params)
+    snapshots = [copy.deepcopy(datahandler.indicators)]
+    test_starts = [test_start for train_start, test_start, test_end in windows]
+    for test_start, next_test_start in zip(test_starts[:-1], test_starts[1:]):
+        for indicator in datahandler.indicators.itervalues():
+            indicator.warmup(datahandler.stamps, datahandler.columns, test_start, next_test_start)
+        snapshots.append(copy.deepcopy(datahandler.indicators))
+    return snapshots
+
+
+def _run_fold(job):
+    fold, strategy_class, params, workfile, window, length, indicators, kwargs = job
+    train_start, test_start, test_end = window
+    end = min(test_end + 1, length)
+    try:
+        result = run_backtest(strategy_class, params, workfile, start=train_start, end=end,
+                              test_bars=end - test_start, indicators=indicators, **kwargs)
+        return fold, result.equity, result.metrics()
+    except Exception:
+        return fold, pd.Series(), {'error': traceback.format_exc()}
+
+
+class WalkForwardResult(object):
+    """
+    Outcome of walk_forward
+    folds - list of (window, metrics) per fold
+    equity - stitched out-of-sample equity curve
+    """
+
+    def __init__(self, windows, fold_equity, fold_metrics, capital):
+        self.folds = zip(windows, fold_metrics)
+        self.fold_equity = fold_equity
+        self.equity = self.stitch(fold_equity, capital)
+
+    @staticmethod
+    def stitch(fold_equity, capital):
+        pieces = []
+        level = capital
+        for equity in fold_equity:
+            if len(equity) == 0:
+                continue
+            pieces.append(equity / equity.iloc[0] * level)
+            level = pieces[-1].iloc[-1]
+        return pd.concat(pieces) if pieces else pd.Series()
+
+    def metrics(self):
+        metrics = equity_metrics(self.equity)
+        metrics['folds'] = len(self.folds)
+        metrics['bars'] = len(self.equity)
+        return metrics
+
+
+def walk_forward(strategy_class, params, workfile, folds=10, train=10000, anchored=False, processes=None,
+                 capital=1000000.0, **kwargs):
+    """
+    Parameters:
+    strategy_class, params - strategy is created as strategy_class(queue, datahandler, **params)
+    workfile - pickle or BarStore directory, a pickle is converted once
+    folds - number of test windows
+    train - bars of history in front of the first (rolling: every) test window
+    processes - pool size, default all cores
+    kwargs - passed to run_backtest (max_leverage)
+    """
+    workfile = shared_workfile(workfile)
+    length = len(BarStore(workfile))
+    windows = walk_forward_windows(length, folds, train, anchored)
+    if anchored:
+        snapshots = indicator_snapshots(strategy_class, params, workfile, windows, length)
+    else:
+        snapshots = [None] * len(windows)
+    kwargs['capital'] = capital
+    jobs = [(fold, strategy_class, params, workfile, window, length, snapshots[fold], kwargs)
+            for fold, window in enumerate(windows)]
+    fold_equity = [None] * len(windows)
+    fold_metrics = [None] * len(windows)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for fold, equity, metrics in pool.imap_unordered(_run_fold, jobs):
+            fold_equity[fold] = equity
+            fold_metrics[fold] = metrics
+    finally:
+        pool.terminate()
+    return WalkForwardResult(windows, fold_equity, fold_metrics, capital)